@@ -0,0 +1,78 @@
+"""
+Benchmark the write throughput of failed records to the local database with SQLite's default settings
+(rollback journal, synchronous=FULL - the setup before the `[database]` performance profile) vs. the profile
+of config.ini (WAL, synchronous=NORMAL, cache_size, mmap_size).
+
+Every record is written with `Database.write_errors` (one transaction per record), and for reference
+with `Database.record_errors` and `flush` (one transaction per `[database] flush_records` records).
+The rows of tests/testdata/smartva_test.csv are cycled to the requested number of rows with unique SIDs.
+Databases are created in a temporary directory - use --dir to measure the disk the database lives on.
+
+Usage: python benchmarks/db_write.py [--rows 2000] [--dir /path/to/disk]
+"""
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from smartvadhis2.core.database import Database, sqlite_pragmas  # noqa: E402
+from smartvadhis2.core.exceptions.errors import SexParseError  # noqa: E402
+from smartvadhis2.core.helpers import read_csv  # noqa: E402
+
+
+def rows(count):
+    template = list(read_csv(os.path.join(ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv')))
+    for i, row in enumerate(itertools.islice(itertools.cycle(template), count)):
+        row = dict(row)
+        row['sid'] = 'VA_{:017d}'.format(i)
+        yield row
+
+
+def write_errors(db, records):
+    for record in records:
+        db.write_errors(record, SexParseError())
+
+
+def record_errors(db, records):
+    for record in records:
+        db.record_errors(record, SexParseError())
+    db.flush()
+
+
+def bench(name, write, pragmas, records, directory):
+    db_file = os.path.join(directory, '{}.db'.format(name.replace(' ', '_')))
+    db = Database('sqlite:///' + db_file, pragmas=pragmas)
+    start = time.perf_counter()
+    write(db, records)
+    elapsed = time.perf_counter() - start
+    db.close()
+    print("{:<28} {:>8} rows in {:>7.2f}s = {:>8.0f} rows/s".format(
+        name, len(records), elapsed, len(records) / elapsed))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark writes of failed records to the local database")
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--dir', default=None)
+    args = parser.parse_args()
+
+    records = list(rows(args.rows))
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        before = bench('write_errors default', write_errors, [], records, directory)
+        after = bench('write_errors profile', write_errors, sqlite_pragmas(), records, directory)
+        bench('record_errors profile', record_errors, sqlite_pragmas(), records, directory)
+    finally:
+        shutil.rmtree(directory)
+    print("speed-up of write_errors: {:.1f}x".format(before / after))
+
+
+if __name__ == '__main__':
+    main()
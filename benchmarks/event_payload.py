@@ -0,0 +1,91 @@
+"""
+Benchmark encoding DHIS2 events: the payload dict of every Event encoded with the stdlib json for the request
+and again for the debug log line vs. the Event body encoded once from the prebuilt envelope (orjson if installed).
+
+The rows of tests/testdata/smartva_test.csv are cycled to the requested number of events,
+which are posted in bulk chunks of 50 events.
+
+Usage: python benchmarks/event_payload.py [--rows 100000]
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from smartvadhis2.__version__ import __version__  # noqa: E402
+from smartvadhis2.core import helpers  # noqa: E402
+from smartvadhis2.core.config import DhisConfig  # noqa: E402
+from smartvadhis2.core.helpers import read_csv, deterministic_uid  # noqa: E402
+from smartvadhis2.core.verbalautopsy import Event, events_body, verbal_autopsy_factory  # noqa: E402
+
+CHUNK_SIZE = 50
+
+
+def legacy_payload(va):
+    event = Event.__new__(Event)
+    event.datavalues = va
+    program = DhisConfig.program_uid
+    return {
+        "event": deterministic_uid(program, va.sid),
+        "program": program,
+        "orgUnit": va.orgunit,
+        "eventDate": va.death_date,
+        "status": "COMPLETED",
+        "storedBy": "smartvadhis2_v{}".format(__version__),
+        "dataValues": event.datavalues
+    }
+
+
+def legacy(vas):
+    payloads = [legacy_payload(va) for va in vas]
+    for i in range(0, len(payloads), CHUNK_SIZE):
+        data = {'events': payloads[i:i + CHUNK_SIZE]}
+        # the debug log line and the request body of `requests`
+        json.dumps(data)
+        json.dumps(data).encode('utf-8')
+
+
+def encoded(vas):
+    events = [Event(va) for va in vas]
+    for i in range(0, len(events), CHUNK_SIZE):
+        body = events_body(events[i:i + CHUNK_SIZE])
+        body.decode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark encoding events")
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = list(read_csv(os.path.join(ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv')))
+    vas = [verbal_autopsy_factory(row)[0] for row in itertools.islice(itertools.cycle(rows), args.rows)]
+
+    # both variants create the events from VerbalAutopsy instances
+    start = time.perf_counter()
+    legacy(vas)
+    before = time.perf_counter() - start
+    print("{:<22} {:>8} events in {:>6.2f}s = {:>5.2f} us/event".format(
+        'payload + json x2', args.rows, before, 1e6 * before / args.rows))
+
+    variants = [('body (stdlib json)', None)]
+    if helpers.orjson is not None:
+        variants.append(('body (orjson)', helpers.orjson))
+    installed = helpers.orjson
+    for name, backend in variants:
+        helpers.orjson = backend
+        try:
+            start = time.perf_counter()
+            encoded(vas)
+            after = time.perf_counter() - start
+        finally:
+            helpers.orjson = installed
+        print("{:<22} {:>8} events in {:>6.2f}s = {:>5.2f} us/event, speed-up {:.1f}x".format(
+            name, args.rows, after, 1e6 * after / args.rows, before / after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Benchmark the overhead of logging on the per-record path of an import at the INFO level.
+
+A record goes through the real functions of an import: validation, creating its event, `Dhis.post_event`
+(with a session that answers like DHIS2 without any network) and `run._handle` (with a local database that
+does nothing), with the console and the log file writing to os.devnull.
+Its cost is reported with the level at WARNING, INFO and DEBUG.
+
+At INFO, the log calls of the path that are not emitted (DEBUG lines and their `isEnabledFor` guards) are counted,
+and so are the objects formatted for them (records, VerbalAutopsy, events and their body) - which must be none.
+The overhead is the number of such calls times the cost of one (timed in a loop of its own, as the variance
+of a whole record is larger than what they cost) relative to the cost of a record at INFO.
+
+Exits with 1 if anything is formatted for a log call that is not emitted,
+or if those calls add more than --max-overhead percent.
+
+Usage: python benchmarks/logging_overhead.py [--rows 20000] [--max-overhead 2] [--repeat 5]
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+import logzero
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from smartvadhis2 import run  # noqa: E402
+from smartvadhis2.core.dhis import Dhis  # noqa: E402
+from smartvadhis2.core.helpers import NOT_IN_HEADER, MappedRow, read_csv  # noqa: E402
+from smartvadhis2.core.mapping import MAPPING_PLAN  # noqa: E402
+from smartvadhis2.core.verbalautopsy import Event, VerbalAutopsy, verbal_autopsy_factory  # noqa: E402
+
+logger = logzero.logger
+
+RESPONSE = {
+    'httpStatusCode': 200,
+    'response': {
+        'imported': 1,
+        'updated': 0,
+        'ignored': 0,
+        'deleted': 0,
+        'importSummaries': [
+            {'status': 'SUCCESS', 'importCount': {'imported': 1, 'updated': 0}, 'reference': 'IgEemKlf33z'}
+        ]
+    }
+}
+
+
+class Response(object):
+    """requests.Response of a successful import of a single event"""
+    def json(self):
+        return RESPONSE
+
+    def raise_for_status(self):
+        pass
+
+
+class Session(object):
+    """requests.Session that answers every POST like DHIS2"""
+    def post(self, url, params=None, auth=None, headers=None, data=None):
+        return Response()
+
+
+class NoDatabase(object):
+    def record_errors(self, data, errors):
+        pass
+
+    def record_imported(self, sid, event_uid):
+        pass
+
+    def record_validation_failure(self, rowhash, sid, errors, warnings):
+        pass
+
+
+class Counted(object):
+    """Counts the log calls that are not emitted and the objects formatted for logging"""
+    def __init__(self):
+        self.not_emitted = 0
+        self.formatted = 0
+
+
+class CountedBody(bytes):
+    """Body of an event that counts how often it is decoded for logging"""
+    counted = None
+
+    def decode(self, *args, **kwargs):
+        CountedBody.counted.formatted += 1
+        return bytes.decode(self, *args, **kwargs)
+
+
+def offline_dhis():
+    """Dhis without connecting to a server"""
+    dhis = Dhis.__new__(Dhis)
+    dhis.api_url = 'https://dhis2.example.org/api/28'
+    dhis.auth = ('admin', 'district')
+    dhis.headers = {'User-Agent': 'smartvadhis2'}
+    dhis._local = threading.local()
+    dhis._local.session = Session()
+    return dhis
+
+
+def process(records, dhis, counted_body=False):
+    """The per-record path of an import"""
+    db = NoDatabase()
+    summary = run.Summary()
+    imported = set()
+    for index, record in enumerate(records, 1):
+        job = run.Job(index, record, 100.0 * index / len(records))
+        job.va, job.errors, job.warnings = verbal_autopsy_factory(record)
+        job.event = Event(job.va)
+        if counted_body:
+            job.event.body = CountedBody(job.event.body)
+        job.outcome = (dhis.post_event(job.event), None)
+        run._handle(job, db, summary, imported)
+
+
+def count_at_info(records, dhis):
+    """Run the records at INFO and count log calls that are not emitted and objects formatted for logging"""
+    counted = Counted()
+    is_enabled_for = logger.isEnabledFor
+
+    def counting_is_enabled_for(level):
+        enabled = is_enabled_for(level)
+        if not enabled:
+            counted.not_emitted += 1
+        return enabled
+
+    def counting(method):
+        def formatted(self):
+            counted.formatted += 1
+            return method(self)
+        return formatted
+
+    patched = [(cls, name, cls.__dict__[name])
+               for cls, name in ((MappedRow, '__repr__'), (VerbalAutopsy, '__str__'), (Event, '__str__'))]
+    logger.setLevel(logging.INFO)
+    logger.isEnabledFor = counting_is_enabled_for
+    CountedBody.counted = counted
+    for cls, name, method in patched:
+        setattr(cls, name, counting(method))
+    try:
+        process(records, dhis, counted_body=True)
+    finally:
+        del logger.isEnabledFor
+        for cls, name, method in patched:
+            setattr(cls, name, method)
+    return counted
+
+
+def not_emitted_call(count):
+    for i in range(count):
+        logger.debug("Parsed from CSV: %s", i)
+
+
+def fastest(func, args, repeat):
+    """Fastest of `repeat` calls in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def setup_logging(devnull):
+    """The handlers of LoggingConfig.setup, writing to os.devnull"""
+    logzero.setup_default_logger(level=logging.INFO, formatter=logzero.LogFormatter(
+        fmt='%(color)s* %(levelname)1s%(end_color)s  %(asctime)s  %(message)s [%(module)s:%(lineno)d]'))
+    for handler in logger.handlers:
+        handler.setStream(devnull)
+    logzero.logfile(os.devnull, loglevel=logging.DEBUG, formatter=logzero.LogFormatter(
+        fmt='* %(levelname)1s  %(asctime)s  %(message)s [%(module)s:%(lineno)d]'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of logging per record")
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--max-overhead', type=float, default=2.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    template = list(read_csv(os.path.join(ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv')))
+    # valid records, which go all the way to "Import successful!", read like `run._read_ahead` does
+    for row, age in zip(template, ['48', '82', '0.02']):
+        row.update(age=age, birth_date='1970-01-01')
+    template = [tuple.__new__(MappedRow, tuple(row.get(name, NOT_IN_HEADER) for name in MAPPING_PLAN.csv_fields))
+                for row in template]
+    records = list(itertools.islice(itertools.cycle(template), args.rows))
+    dhis = offline_dhis()
+
+    with open(os.devnull, 'w') as devnull:
+        setup_logging(devnull)
+        per_record = {}
+        for level in (logging.WARNING, logging.INFO, logging.DEBUG):
+            logger.setLevel(level)
+            per_record[level] = fastest(process, (records, dhis), args.repeat) / args.rows
+        logger.setLevel(logging.INFO)
+        per_call = fastest(not_emitted_call, (args.rows,), args.repeat) / args.rows
+        counted = count_at_info(records, dhis)
+
+    for level in (logging.WARNING, logging.INFO, logging.DEBUG):
+        print("record at {:<31} {:>7.2f} us/record".format(logging.getLevelName(level), 1e6 * per_record[level]))
+    calls = float(counted.not_emitted) / args.rows
+    overhead = 100.0 * calls * per_call / per_record[logging.INFO]
+    print("log calls not emitted at INFO           {:>7.2f} per record x {:.2f} us = {:.2f}%".format(
+        calls, 1e6 * per_call, overhead))
+    print("objects formatted for them              {:>7d}".format(counted.formatted))
+
+    if counted.formatted:
+        print("FAIL: {} objects were formatted for log calls that are not emitted".format(counted.formatted))
+        sys.exit(1)
+    if overhead > args.max_overhead:
+        print("FAIL: log calls that are not emitted add {:.2f}% > {:.2f}%".format(overhead, args.max_overhead))
+        sys.exit(1)
+    print("OK: log calls that are not emitted add {:.2f}% <= {:.2f}%".format(overhead, args.max_overhead))
+
+
+if __name__ == '__main__':
+    main()
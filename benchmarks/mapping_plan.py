@@ -0,0 +1,116 @@
+"""
+Benchmark the per-row cost of transforming SmartVA records (row data, VerbalAutopsy, DHIS2 data values,
+local database rows) with the Mapping classes looked up for every row vs. the compiled MAPPING_PLAN.
+
+The rows of tests/testdata/smartva_test.csv (SmartVA output, the input of the transformation) are cycled
+to the requested number of rows, i.e. the size of a SmartVA run of the 1000 ODK records of
+tests/testdata/load_test_1000_odk_records.csv scaled to 1M.
+
+Usage: python benchmarks/mapping_plan.py [--rows 1000000]
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+from collections import OrderedDict
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from smartvadhis2.core.config import ODKConfig, SmartVAConfig  # noqa: E402
+from smartvadhis2.core.database import Database  # noqa: E402
+from smartvadhis2.core.exceptions import ValidationError, ValidationWarning  # noqa: E402
+from smartvadhis2.core.helpers import read_csv, sanitize  # noqa: E402
+from smartvadhis2.core.mapping import Mapping  # noqa: E402
+from smartvadhis2.core.verbalautopsy import VerbalAutopsy, Event, verbal_autopsy_factory  # noqa: E402
+
+
+def legacy_process_row_data(data):
+    row_data = OrderedDict()
+    for i in Mapping.set_order_range():
+        row_data.update(sorted({
+            mapping.code_name: sanitize(data, mapping.csv_name)
+            for mapping in Mapping.properties()
+            if mapping.set_order == i and mapping.csv_name is not None
+        }.items(), key=lambda t: t[0]))
+    return row_data
+
+
+def legacy_verbal_autopsy_factory(data):
+    row_data = legacy_process_row_data(data)
+    va = VerbalAutopsy()
+    exceptions = []
+    warnings = []
+    for k, v in row_data.items():
+        try:
+            setattr(va, k, v)
+            va.algorithm_version = SmartVAConfig.algorithm_version
+            va.questionnaire_version = ODKConfig.form_id
+        except ValidationError as e:
+            exceptions.append(e)
+        except ValidationWarning as e:
+            warnings.append(e)
+    return va, exceptions, warnings
+
+
+def legacy_datavalues(va):
+    return [
+        {
+            "dataElement": mapping.dhis_uid,
+            "value": va[mapping.code_name]
+        }
+        for mapping in Mapping.properties()
+        if all([mapping.code_name, mapping.dhis_uid])
+        and va[mapping.code_name] is not None
+    ]
+
+
+def legacy_to_sql_rows(data):
+    return {
+        mapping.code_name: data[mapping.csv_name]
+        for mapping in Mapping.properties()
+        if mapping.csv_name is not None
+        and data[mapping.csv_name] != ''
+    }
+
+
+def legacy(row):
+    va, exceptions, _ = legacy_verbal_autopsy_factory(row)
+    legacy_to_sql_rows(row)
+    if not exceptions:
+        return legacy_datavalues(va)
+
+
+def compiled(row):
+    va, exceptions, _ = verbal_autopsy_factory(row)
+    Database._to_sql_rows(row)
+    if not exceptions:
+        return Event(va).datavalues
+
+
+def bench(name, transform, rows, count):
+    start = time.perf_counter()
+    for row in itertools.islice(itertools.cycle(rows), count):
+        transform(row)
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>10} rows in {:>8.2f}s = {:>6.2f} us/row".format(name, count, elapsed, 1e6 * elapsed / count))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the compiled Mapping plan")
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    rows = list(read_csv(os.path.join(ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv')))
+    # both variants must produce the same data values
+    assert [legacy(row) for row in rows] == [compiled(row) for row in rows]
+
+    before = bench('before', legacy, rows, args.rows)
+    after = bench('after', compiled, rows, args.rows)
+    print("speed-up: {:.1f}x".format(before / after))
+
+
+if __name__ == '__main__':
+    main()
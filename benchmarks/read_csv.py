@@ -0,0 +1,69 @@
+"""
+Benchmark reading a SmartVA file into dicts of all columns (csv.DictReader) vs. MappedRows of the Mapping's columns.
+
+The rows of tests/testdata/smartva_test.csv are cycled to the requested number of rows with unique SIDs
+and written to a temporary file. Memory is the size of all rows of the file held in a list.
+
+Usage: python benchmarks/read_csv.py [--rows 1000000]
+"""
+import argparse
+import csv
+import itertools
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from smartvadhis2.core.helpers import read_csv  # noqa: E402
+
+
+def write_file(path, count):
+    with open(os.path.join(ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv')) as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        template = list(reader)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for i, row in enumerate(itertools.islice(itertools.cycle(template), count)):
+            writer.writerow(dict(row, sid='VA_{:017d}'.format(i)))
+
+
+def bench(name, path, count, mapped_only):
+    start = time.perf_counter()
+    for _ in read_csv(path, with_progress=True, mapped_only=mapped_only):
+        pass
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    rows = list(read_csv(path, mapped_only=mapped_only))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    print("{:<12} {:>10} rows in {:>7.2f}s = {:>5.2f} us/row, {:>6.1f} MB = {:>4.0f} bytes/row".format(
+        name, count, elapsed, 1e6 * elapsed / count, memory / 2 ** 20, memory / count))
+    return elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CSV reader modes")
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        write_file(path, args.rows)
+        dict_time, dict_memory = bench('DictReader', path, args.rows, mapped_only=False)
+        mapped_time, mapped_memory = bench('MappedRow', path, args.rows, mapped_only=True)
+        print("speed-up: {:.1f}x, memory: {:.1f}x less".format(dict_time / mapped_time, dict_memory / mapped_memory))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
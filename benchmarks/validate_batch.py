@@ -0,0 +1,58 @@
+"""
+Benchmark validating a SmartVA file record by record (verbal_autopsy_factory) vs. as columns (validate_batch).
+
+The rows of tests/testdata/smartva_test.csv are cycled to the requested number of rows with unique SIDs
+and some invalid ages, sexes and ICD-10 codes.
+
+Usage: python benchmarks/validate_batch.py [--rows 1000000]
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from smartvadhis2.core.helpers import DictionaryColumn, read_csv  # noqa: E402
+from smartvadhis2.core.verbalautopsy import numpy, validate_batch, verbal_autopsy_factory  # noqa: E402
+
+
+def rows(count):
+    template = list(read_csv(os.path.join(ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv')))
+    for i, row in enumerate(itertools.islice(itertools.cycle(template), count)):
+        row = dict(row)
+        row['sid'] = 'VA_{:017d}'.format(i)
+        row['age'] = ['48', '82', '0.02', '140'][i % 4]
+        row['sex'] = ['1', '2', '7'][i % 3]
+        row['icd10'] = ['Y09', 'E14', 'Q89', 'XXX', ''][i % 5]
+        yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark columnar validation")
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for row in rows(args.rows):
+        verbal_autopsy_factory(row)
+    records = time.perf_counter() - start
+    print("verbal_autopsy_factory {:>10} rows in {:>7.2f}s".format(args.rows, records))
+
+    columns = {}
+    for row in rows(args.rows):
+        for name, value in row.items():
+            columns.setdefault(name, DictionaryColumn()).append(value)
+
+    start = time.perf_counter()
+    validate_batch(columns)
+    batch = time.perf_counter() - start
+    print("validate_batch         {:>10} rows in {:>7.2f}s ({})".format(
+        args.rows, batch, 'NumPy' if numpy is not None else 'pure Python'))
+    print("speed-up: {:.1f}x".format(records / batch))
+
+
+if __name__ == '__main__':
+    main()
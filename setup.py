@@ -78,6 +78,14 @@ setup(
         'alembic',
         'apscheduler'
     ],
+    extras_require={
+        # [dhis] engine = asyncio
+        'async': ['aiohttp'],
+        # vectorised verbalautopsy.validate_batch
+        'numpy': ['numpy'],
+        # faster JSON encoding of events
+        'orjson': ['orjson']
+    },
     packages=find_packages(),
     classifiers=[
         # Trove classifiers
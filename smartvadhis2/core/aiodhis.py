@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import json
+
+from logzero import logger
+
+from .config import DhisConfig, SMARTVADHIS2_VERSION
+from .dhis import (
+    RaiseImportFailure,
+    raise_if_duplicate,
+    parse_existing_events,
+    normalize_url,
+    events_query_params,
+    Dhis
+)
+from .exceptions.base import (
+    SmartVADHIS2Exception,
+    DhisApiException
+)
+from .exceptions.errors import OrgUnitNotAssignedError
+from .helpers import dump_json
+from .verbalautopsy import events_body
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+"""
+Module for asynchronous DHIS2 access - the asyncio counterpart of core.dhis
+"""
+
+
+class AsyncDhis(object):
+    """Class for accessing DHIS2 with many concurrent requests on a single thread.
+    The number of requests in flight is limited by a semaphore of `[dhis] async_concurrency`.
+    Use it as an async context manager or call `connect()` and `close()`.
+    """
+    def __init__(self, concurrency=None, root_orgunit=None):
+        if aiohttp is None:
+            raise SmartVADHIS2Exception("aiohttp is required for [dhis] engine = asyncio - pip install aiohttp")
+
+        url = normalize_url(DhisConfig.baseurl)
+        self.api_url = '{}/api/{}'.format(url, DhisConfig.api_version)
+        credentials = '{}:{}'.format(DhisConfig.username, DhisConfig.password).encode('utf-8')
+        self.headers = {
+            'User-Agent': 'smartvadhis2_v.{}'.format(SMARTVADHIS2_VERSION),
+            'Authorization': 'Basic {}'.format(base64.b64encode(credentials).decode('ascii'))
+        }
+        self.concurrency = concurrency or DhisConfig.async_concurrency
+        self.root_orgunit = root_orgunit
+        self.dhis_version = None
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def connect(self):
+        """Open the HTTP session - must be called from within the running event loop"""
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        logger.info("Connecting to DHIS2 on {} (async, {} concurrent requests)".format(self.api_url, self.concurrency))
+        if not self.root_orgunit:
+            self.root_orgunit = await self.get_root_orgunit()
+        self.dhis_version = await self.get_dhis_version()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, method, url, params=None, data=None):
+        """Send a request once the semaphore allows it, returns a tuple of (HTTP status, JSON or text response)
+        data: a dict or already encoded JSON bytes
+        """
+        headers = None
+        if data is not None:
+            data = data if isinstance(data, bytes) else dump_json(data)
+            headers = {'Content-Type': 'application/json'}
+        async with self.semaphore:
+            async with self.session.request(method, url, params=params, data=data, headers=headers) as r:
+                text = await r.text()
+                try:
+                    return r.status, json.loads(text)
+                except ValueError:
+                    return r.status, text
+
+    async def get(self, endpoint, params=None):
+        """DHIS2 HTTP GET, returns a tuple of (HTTP status, JSON response)"""
+        url = '{}/{}.json'.format(self.api_url, endpoint)
+        logger.debug('GET: %s - Params: %s', url, params)
+        return await self._request('GET', url, params=params)
+
+    async def post(self, endpoint, data, params=None):
+        """DHIS2 HTTP POST, returns a tuple of (HTTP status, JSON response)"""
+        url = '{}/{}'.format(self.api_url, endpoint)
+        logger.debug('POST: %s - Params: %s', url, params)
+        return await self._request('POST', url, params=params, data=data)
+
+    async def delete(self, endpoint):
+        """DHIS2 HTTP DELETE, returns a tuple of (HTTP status, JSON response)"""
+        url = '{}/{}'.format(self.api_url, endpoint)
+        return await self._request('DELETE', url)
+
+    async def post_event(self, data):
+        """POST DHIS2 Event (an Event, sent as its encoded body, or a dict) and return the UID of the created event"""
+        body = getattr(data, 'body', data)
+        status, response = await self.post(endpoint='events', data=body, params=Dhis.import_params())
+        try:
+            import_status = RaiseImportFailure(response)
+        except OrgUnitNotAssignedError:
+            await self.assign_orgunit_to_program(getattr(data, 'payload', data))
+            status, response = await self.post(endpoint='events', data=body, params=Dhis.import_params())
+            import_status = RaiseImportFailure(response)
+        if status >= 400:
+            raise DhisApiException("POST failed - {} {}".format(status, response))
+        return import_status.references[0] if import_status.references else None
+
+    async def post_events(self, events):
+        """POST a chunk of DHIS2 Events in one request (bulk import)
+        Returns a list of (sid, event UID, exception) tuples - exception is None if the event was imported
+        """
+        results = await self._post_events(events)
+
+        not_assigned = {sid for sid, _, exc in results if isinstance(exc, OrgUnitNotAssignedError)}
+        if not_assigned:
+            retry = [e for e in events if e.sid in not_assigned]
+            for orgunit in {e.orgunit for e in retry}:
+                await self.assign_orgunit_to_program({'orgUnit': orgunit})
+            retried = {result[0]: result for result in await self._post_events(retry)}
+            results = [retried.get(result[0], result) for result in results]
+        return results
+
+    async def _post_events(self, events):
+        _, response = await self.post(endpoint='events', data=events_body(events), params=Dhis.import_params())
+        return RaiseImportFailure.per_event(response, [e.sid for e in events], [e.uid for e in events])
+
+    async def is_duplicate(self, sid):
+        """Check DHIS2 for a duplicate event by SID across all OrgUnits"""
+        params = events_query_params(self.root_orgunit, 'EQ:{}'.format(sid))
+        _, response = await self.get(endpoint='events/query', params=params)
+        raise_if_duplicate(response, sid)
+
+    async def existing_events(self, sids, chunk_size=None):
+        """Check DHIS2 for existing events of many SIDs, all chunks concurrently.
+        Returns a dict of {SID: [event UIDs]} for those SIDs that already exist
+        """
+        chunk_size = chunk_size or DhisConfig.duplicate_check_chunk_size
+        sids = sorted(set(sids))
+
+        async def query(chunk):
+            params = events_query_params(self.root_orgunit, 'IN:{}'.format(';'.join(chunk)))
+            params['skipPaging'] = 'true'
+            _, response = await self.get(endpoint='events/query', params=params)
+            return parse_existing_events(response)
+
+        existing = {}
+        responses = await asyncio.gather(*[query(sids[i:i + chunk_size]) for i in range(0, len(sids), chunk_size)])
+        for found in responses:
+            for sid, event_uids in found.items():
+                existing.setdefault(sid, []).extend(event_uids)
+        return existing
+
+    async def get_root_orgunit(self):
+        params = {
+            'fields': 'id',
+            'filter': 'level:eq:1'
+        }
+        _, response = await self.get(endpoint='organisationUnits', params=params)
+        root_orgunit_uid = Dhis._get_root_id(response)
+        logger.info("Root org unit to query: {}".format(root_orgunit_uid))
+        return root_orgunit_uid
+
+    async def get_dhis_version(self):
+        _, response = await self.get(endpoint='system/info')
+        return response.get('version')
+
+    async def assign_orgunit_to_program(self, data):
+        """Assign OrgUnit to program"""
+        params = {
+            'fields': ':owner'
+        }
+        _, existing = await self.get('programs/{}'.format(DhisConfig.program_uid), params=params)
+        org_unit = data['orgUnit']
+
+        if org_unit not in [ou['id'] for ou in existing['organisationUnits']]:
+            existing['organisationUnits'].append({"id": org_unit})
+            await self.post('metadata', data={'programs': [existing]})
+            logger.info("Assigned orgUnit %s", org_unit)
@@ -1,11 +1,14 @@
+import atexit
 import json
 import os
 import platform
+import queue
 import subprocess
 import logging  # keep for LoggingConfig.setup()
 import stat
 import sys
 from configparser import ConfigParser
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import logzero
 from logzero import logger
@@ -59,6 +62,12 @@ class LoggingConfig(Config):
     log_file = Config._parser.get('logging', 'logfile')
     __log_level_from_config = Config._parser.get('logging', 'level')
     log_level = eval('logging.{}'.format(__log_level_from_config.upper()))
+    # write the log file in a background thread so disk I/O and rotation do not stall an import
+    async_logfile = Config._parser.getboolean(__section__, 'async_logfile', fallback=False)
+
+    # QueueHandler and QueueListener of the log file with `async_logfile`
+    _queue_handler = None
+    _listener = None
 
     def setup(self):
 
@@ -74,10 +83,52 @@ class LoggingConfig(Config):
         log_format_no_color = '* %(levelname)1s  %(asctime)s  %(message)s [%(module)s:%(lineno)d]'
         formatter_no_color = logzero.LogFormatter(fmt=log_format_no_color)
         # Log rotation of 20 files for 10MB each
-        logzero.logfile(self.log_file, formatter=formatter_no_color, loglevel=self.log_level, maxBytes=int(1e7), backupCount=20)
+        if self.async_logfile:
+            self._logfile_in_background(formatter_no_color)
+        else:
+            logzero.logfile(self.log_file, formatter=formatter_no_color, loglevel=self.log_level, maxBytes=int(1e7), backupCount=20)
 
         logger.info("smartvadhis2 v.{}".format(__version__))
 
+    def _logfile_in_background(self, formatter):
+        """Put log records into a queue, a QueueListener thread writes (and rotates) the log file"""
+        self.stop_logfile()
+        file_handler = RotatingFileHandler(self.log_file, maxBytes=int(1e7), backupCount=20, encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(self.log_level)
+
+        records = queue.Queue(-1)
+        LoggingConfig._listener = QueueListener(records, file_handler, respect_handler_level=True)
+        LoggingConfig._listener.start()
+        # write the records still queued when the application exits
+        atexit.register(self.stop_logfile)
+
+        LoggingConfig._queue_handler = _LocalQueueHandler(records)
+        LoggingConfig._queue_handler.setLevel(self.log_level)
+        logger.addHandler(LoggingConfig._queue_handler)
+
+    @staticmethod
+    def stop_logfile():
+        """Write the queued log records and close the log file written in the background"""
+        if LoggingConfig._queue_handler is not None:
+            logger.removeHandler(LoggingConfig._queue_handler)
+            LoggingConfig._queue_handler = None
+        if LoggingConfig._listener is not None:
+            LoggingConfig._listener.stop()
+            for handler in LoggingConfig._listener.handlers:
+                handler.close()
+            LoggingConfig._listener = None
+
+
+class _LocalQueueHandler(QueueHandler):
+    """QueueHandler for a QueueListener in the same process: only the message is rendered in the logging thread,
+    the log file formatter (timestamp, traceback) runs in the listener thread
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 
 class DataDirConfig(Config):
     """Class to set up the `data` directory containing both Briefcases and SmartVA files"""
@@ -137,6 +188,15 @@ class DatabaseConfig(Config):
     database_dir = os.path.join(Config.ROOT_DIR, 'db')
     db_name = Config._parser.get(__section__, 'db_name')
     db_queries_log = Config._parser.getboolean(__section__, 'db_queries_log')
+    # the database writer thread commits up to `flush_records` queued writes at once,
+    # producers wait while `writer_queue_size` writes are queued
+    flush_records = Config._parser.getint(__section__, 'flush_records', fallback=100)
+    writer_queue_size = Config._parser.getint(__section__, 'writer_queue_size', fallback=1000)
+    # SQLite performance profile, applied to every connection
+    journal_mode = Config._parser.get(__section__, 'journal_mode', fallback='wal')
+    synchronous = Config._parser.get(__section__, 'synchronous', fallback='normal')
+    cache_size = Config._parser.getint(__section__, 'cache_size', fallback=-20000)
+    mmap_size = Config._parser.getint(__section__, 'mmap_size', fallback=268435456)
 
     def setup(self):
         self.create_dir(self.database_dir, created_message=True)
@@ -154,11 +214,45 @@ class DhisConfig(Config):
 
     api_version = Config._parser.getint(__section__, 'api_version')
 
+    # number of events per bulk POST - 0 or 1 posts every event on its own
+    bulk_chunk_size = Config._parser.getint(__section__, 'bulk_chunk_size', fallback=0)
+
+    # number of SIDs per duplicate check request - 0 checks every SID on its own
+    duplicate_check_chunk_size = Config._parser.getint(__section__, 'duplicate_check_chunk_size', fallback=50)
+
+    # rely on deterministic event UIDs instead of querying DHIS2 for duplicates
+    skip_duplicate_check = Config._parser.getboolean(__section__, 'skip_duplicate_check', fallback=False)
+
+    # number of threads checking for duplicates and posting events concurrently
+    workers = Config._parser.getint(__section__, 'workers', fallback=1)
+
+    # `threads` or `asyncio` (requires aiohttp) to send requests to DHIS2
+    engine = Config._parser.get(__section__, 'engine', fallback='threads')
+    # number of requests in flight with the asyncio engine
+    async_concurrency = Config._parser.getint(__section__, 'async_concurrency', fallback=100)
+
     if not all([baseurl, username, password]):
         raise FileException(
             "[{}] Empty baseurl, username or password. Check docs for proper format.".format(__section__))
 
 
+class PipelineConfig(Config):
+    """Class to set up the stages of an import (read, validate, resolve duplicates, post, record)"""
+    __section__ = 'pipeline'
+
+    # number of threads validating records - posting uses [dhis] workers
+    validate_workers = Config._parser.getint(__section__, 'validate_workers', fallback=1)
+
+    # number of processes validating records (e.g. for large backfills) - 0 validates in the threads above
+    validate_processes = Config._parser.getint(__section__, 'validate_processes', fallback=0)
+
+    # number of read-ahead windows queued between two stages
+    queue_size = Config._parser.getint(__section__, 'queue_size', fallback=2)
+
+    # which record of a SID that is in a file more than once is imported: `last_row` or `latest_interview_date`
+    duplicate_sid_winner = Config._parser.get(__section__, 'duplicate_sid_winner', fallback='last_row')
+
+
 def check_python_version():
     """Verify that we're on Python 3.5+"""
     required_major = 3
@@ -1,9 +1,12 @@
 import os
+import queue
+import threading
 
 from logzero import logger
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .exceptions.base import (
     SmartVADHIS2Exception,
@@ -12,13 +15,13 @@ from .exceptions.base import (
 
 from .exceptions import db_exceptions
 from .config import DatabaseConfig
-from .models import Person, Failure, PersonFailure
-from .mapping import Mapping
+from .models import Person, Failure, PersonFailure, ImportedEvent, Checkpoint, ValidationFailure
+from .mapping import MAPPING_PLAN
 
 
 class Database(object):
     """Local database"""
-    def __init__(self, db_url=None):
+    def __init__(self, db_url=None, pragmas=None):
         self.db_queries_log = DatabaseConfig.db_queries_log
         if not db_url:
             self.db_filename = os.path.join(DatabaseConfig.database_dir, DatabaseConfig.db_name)
@@ -26,23 +29,62 @@ class Database(object):
         else:
             self.db_filename = db_url.replace('sqlite:///', '')
             self.db_url = db_url
+        # PRAGMAs set on every connection, defaults to the performance profile of the `[database]` section
+        self.pragmas = sqlite_pragmas() if pragmas is None else pragmas
+        # one engine (and pool of connections) shared by all sessions
+        self.engine = self._create_engine()
+        self.Session = sessionmaker(bind=self.engine)
 
         if not os.path.exists(self.db_filename):
             self._create_db()
             self._insert_failure_categories()
         else:
             logger.info("Using database: {}".format(self.db_filename))
-        # create database
-        self.engine = create_engine(self.db_url, echo=self.db_queries_log)
+        # thread writing what the `record_*` methods queue, started on first use
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # databases created by earlier versions do not have these tables and failure categories yet
+        for model in (ImportedEvent, Checkpoint, ValidationFailure):
+            model.__table__.create(bind=self.engine, checkfirst=True)
+        self._update_failure_categories()
+
+    def close(self):
+        """Write everything queued so far, stop the writer thread and close all connections"""
+        try:
+            if self._writer is not None:
+                self._writer.stop()
+        finally:
+            self._writer = None
+            self.engine.dispose()
+
+    def _create_engine(self):
+        """Create the engine with a pool of connections that get `self.pragmas` applied when they are opened"""
+        engine = create_engine(self.db_url,
+                               echo=self.db_queries_log,
+                               poolclass=QueuePool,
+                               connect_args={'check_same_thread': False})
+        pragmas = self.pragmas
+
+        @event.listens_for(engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+            cursor.close()
+
+        return engine
 
     def _create_db(self):
         """Insert SQLAlchemy model (create tables). Removes the file if it fails"""
+        engine = self.engine
         try:
-            engine = create_engine(self.db_url, echo=self.db_queries_log)
             logger.info("Creating database schema...")
             Person.__table__.create(bind=engine)
             Failure.__table__.create(bind=engine)
             PersonFailure.__table__.create(bind=engine)
+            ImportedEvent.__table__.create(bind=engine)
+            Checkpoint.__table__.create(bind=engine)
+            ValidationFailure.__table__.create(bind=engine)
 
         except (OSError, SQLAlchemyError):
             os.remove(self.db_filename)
@@ -58,9 +100,7 @@ class Database(object):
         logger.info("Adding exceptions to database...")
         logger.info("Parsing exception to insert into database...")
         all_exceptions = db_exceptions
-        engine = create_engine(self.db_url, echo=self.db_queries_log)
-        Session = sessionmaker(bind=engine)
-        session = Session()
+        session = self.Session()
         failure_types = [
             {
                 "failureid": err.code,
@@ -85,6 +125,23 @@ class Database(object):
         finally:
             session.close()
 
+    def _update_failure_categories(self):
+        """Insert Exception categories that were added to core.exceptions after the database was created"""
+        session = self.Session()
+        try:
+            known = {row.failureid for row in session.query(Failure.failureid)}
+            session.add_all([
+                Failure(failureid=err.code, failuretype=err.err_type, failuredescription=err.message)
+                for err in db_exceptions
+                if err.code not in known
+            ])
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise SmartVADHIS2Exception(e)
+        finally:
+            session.close()
+
     def write_errors(self, data, errors):
         """Write person record and add person_failures"""
         if not isinstance(errors, list):
@@ -92,54 +149,194 @@ class Database(object):
             errors = [errors]
         values = self._to_sql_rows(data)
 
-        Session = sessionmaker(bind=self.engine)
-        session = Session()
+        session = self.Session()
+        try:
+            personid = self._write_person(session, values)
+            if errors:
+                # person_failures that exist already are kept (composite primary key)
+                session.execute(PersonFailure.__table__.insert().prefix_with('OR IGNORE'),
+                                [{'personid': personid, 'failureid': err.code} for err in errors])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise SmartVADHIS2Exception(e)
+        finally:
+            session.close()
+
+    def record_errors(self, data, errors):
+        """Queue a person record and its failures for the writer thread (see `DatabaseWriter`)"""
+        if not isinstance(errors, list):
+            errors = [errors]
+        self.writer().put(PersonFailure, (self._to_sql_rows(data), [err.code for err in errors]))
+
+    def record_validation_failure(self, rowhash, sid, errors, warnings):
+        """Queue the validation errors and warnings of a row to be cached by the writer thread"""
+        self.writer().put(ValidationFailure, {
+            'rowhash': rowhash,
+            'sid': sid,
+            'errors': ','.join(str(e.code) for e in errors),
+            'warnings': ','.join(str(w.code) for w in warnings)
+        })
 
-        personid = self._write_person(session, values)
+    def record_imported(self, sid, event_uid):
+        """Queue a successfully imported SID and its DHIS2 event UID for the ledger"""
+        self.writer().put(ImportedEvent, {'sid': sid, 'event': event_uid})
 
-        for err in errors:
-            f = PersonFailure(personid=personid, failureid=err.code)
-            failure = session.query(PersonFailure)\
-                .filter(PersonFailure.personid == f.personid,
-                        PersonFailure.failureid == f.failureid)\
-                .one_or_none()
-            if not failure:
-                try:
-                    session.add(f)
-                    session.commit()
-                except Exception as e:
-                    session.rollback()
-                    session.close()
-                    raise SmartVADHIS2Exception(e)
-        session.close()
+    def writer(self):
+        """Return the DatabaseWriter of this database, started on first use"""
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = DatabaseWriter(self)
+        return self._writer
+
+    def flush(self):
+        """Wait until the writer thread has written everything queued so far"""
+        if self._writer is not None:
+            self._writer.drain()
+
+    def _write_batch(self, session, batch):
+        """Write (model, row) pairs queued by the `record_*` methods in one transaction,
+        persons and person_failures that exist already are kept, the others are replaced.
+        Upserts use SQLite's conflict clause (INSERT OR IGNORE / OR REPLACE) which works with every SQLAlchemy
+        and SQLite version"""
+        rows = {PersonFailure: [], ValidationFailure: [], ImportedEvent: []}
+        for model, row in batch:
+            rows[model].append(row)
+
+        connection = session.connection()
+        if rows[PersonFailure]:
+            self._insert_failures(session, rows[PersonFailure])
+        if rows[ValidationFailure]:
+            connection.execute(ValidationFailure.__table__.insert().prefix_with('OR REPLACE'), rows[ValidationFailure])
+        if rows[ImportedEvent]:
+            connection.execute(ImportedEvent.__table__.insert().prefix_with('OR REPLACE'), rows[ImportedEvent])
+        session.commit()
+
+    @staticmethod
+    def _insert_failures(session, failures):
+        """Insert the persons of (values, failure codes) pairs and their person_failures in bulk,
+        rows that exist already (same SID, same person and failure) are kept"""
+        connection = session.connection()
+        persons = [dict(_PERSON_COLUMNS, **values) for values, _ in failures]
+        with_sid = [person for person in persons if person['sid'] is not None]
+        if with_sid:
+            connection.execute(Person.__table__.insert().prefix_with('OR IGNORE'), with_sid)
+
+        personids = {}
+        sids = list({person['sid'] for person in with_sid})
+        # stay below SQLite's limit of variables per statement
+        for i in range(0, len(sids), 500):
+            rows = session.query(Person.sid, Person.personid).filter(Person.sid.in_(sids[i:i + 500]))
+            personids.update((row.sid, row.personid) for row in rows)
+
+        person_failures = set()
+        for person, (_, codes) in zip(persons, failures):
+            if person['sid'] is None:
+                # records without SID can not be told apart, each one is a new person
+                personid = connection.execute(Person.__table__.insert(), person).inserted_primary_key[0]
+            else:
+                personid = personids[person['sid']]
+            person_failures.update((personid, code) for code in codes)
+        if person_failures:
+            connection.execute(PersonFailure.__table__.insert().prefix_with('OR IGNORE'), [
+                {'personid': personid, 'failureid': code} for personid, code in sorted(person_failures)
+            ])
+
+    def imported_sids(self, sids):
+        """Return the set of SIDs that are already in the ledger of imported events"""
+        sids = list(set(sids))
+        session = self.Session()
+        imported = set()
+        try:
+            # stay below SQLite's limit of variables per statement
+            for i in range(0, len(sids), 500):
+                rows = session.query(ImportedEvent.sid).filter(ImportedEvent.sid.in_(sids[i:i + 500]))
+                imported.update(row.sid for row in rows)
+        finally:
+            session.close()
+        return imported
+
+    def validation_failures(self, rowhashes):
+        """Return {row hash: (error codes, warning codes)} of the rows that failed validation before"""
+        rowhashes = list(set(rowhashes))
+        session = self.Session()
+        failures = {}
+        try:
+            # stay below SQLite's limit of variables per statement
+            for i in range(0, len(rowhashes), 500):
+                rows = session.query(ValidationFailure).filter(ValidationFailure.rowhash.in_(rowhashes[i:i + 500]))
+                for row in rows:
+                    failures[row.rowhash] = (_codes(row.errors), _codes(row.warnings))
+        finally:
+            session.close()
+        return failures
+
+    def get_checkpoint(self, filehash):
+        """Return the Checkpoint of a SmartVA file or None if it was never interrupted"""
+        session = self.Session()
+        try:
+            return session.query(Checkpoint).filter(Checkpoint.filehash == filehash).one_or_none()
+        finally:
+            session.close()
+
+    def unfinished_checkpoints(self):
+        """Return all Checkpoints of interrupted runs, oldest first"""
+        session = self.Session()
+        try:
+            return session.query(Checkpoint).order_by(Checkpoint.created).all()
+        finally:
+            session.close()
+
+    def write_checkpoint(self, filehash, filename, lastrow, summary):
+        """Store the last row of a SmartVA file that was written to the database and the counters so far"""
+        session = self.Session()
+        try:
+            session.merge(Checkpoint(filehash=filehash,
+                                     filename=filename,
+                                     lastrow=lastrow,
+                                     records=summary.records,
+                                     imported=summary.imported,
+                                     duplicates=summary.duplicates,
+                                     errors=summary.errors))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise SmartVADHIS2Exception(e)
+        finally:
+            session.close()
+
+    def delete_checkpoint(self, filehash):
+        """Remove the Checkpoint of a SmartVA file once it was processed completely"""
+        session = self.Session()
+        try:
+            session.query(Checkpoint).filter(Checkpoint.filehash == filehash).delete()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise SmartVADHIS2Exception(e)
+        finally:
+            session.close()
 
     @staticmethod
     def _write_person(session, values):
-        """Write a Person instance to the database
-        but re-use the record if it's already existing
+        """Write a Person to the database
+        but re-use the record if it's already existing (INSERT OR IGNORE on the unique SID)
         and return the personid
         """
-        p = Person(**values)
-        person = session.query(Person).filter(Person.sid == p.sid).one_or_none()
-        if not person:
-            person = p
-            try:
-                session.add(person)
-                session.flush()
-            except Exception as e:
-                session.rollback()
-                raise SmartVADHIS2Exception(e)
-        return person.personid
+        result = session.execute(Person.__table__.insert().prefix_with('OR IGNORE').values(**values))
+        if result.rowcount:
+            return result.inserted_primary_key[0]
+        return session.query(Person.personid).filter(Person.sid == values['sid']).scalar()
 
     @staticmethod
     def _to_sql_rows(data):
         """Convert data rows to a dict ready for insertion"""
         try:
             d = {
-                mapping.code_name: data[mapping.csv_name]
-                for mapping in Mapping.properties()
-                if mapping.csv_name is not None
-                and data[mapping.csv_name] != ''
+                code_name: data[csv_name]
+                for csv_name, code_name in MAPPING_PLAN.row_fields
+                if data[csv_name] != ''
             }
         except KeyError as e:
             raise SmartVADHIS2Exception("Mapping is not aligned with CSV rows %s", e)
@@ -147,9 +344,114 @@ class Database(object):
             return d
 
 
-# "singleton" for db connection
-database = Database()
+class DatabaseWriter(object):
+    """The single thread writing failures and imported events to the local database. It owns its session,
+    so producers never wait for SQLite's lock - only for space in the queue of `[database] writer_queue_size`
+    writes. Whatever is queued, up to `[database] flush_records` writes, is committed in one transaction.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._queue = queue.Queue(maxsize=DatabaseConfig.writer_queue_size)
+        # first exception of a failed transaction, raised to the producers
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='database-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, model, row):
+        """Queue a row of `model`, blocks while the queue is full"""
+        self._raise_error()
+        self._queue.put((model, row))
+
+    def drain(self):
+        """Wait until every queued row is committed"""
+        self._queue.join()
+        self._raise_error()
+
+    def stop(self):
+        """Write what is queued and end the thread"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise SmartVADHIS2Exception(error)
+
+    def _run(self):
+        session = self.db.Session()
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < DatabaseConfig.flush_records:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.db._write_batch(session, [item for item in batch if item is not None])
+                except Exception as e:
+                    session.rollback()
+                    logger.error("Could not write to the local database: %s", e)
+                    if self._error is None:
+                        self._error = e
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+                if None in batch:
+                    return
+        finally:
+            session.close()
+
+
+def sqlite_pragmas():
+    """PRAGMAs of the SQLite performance profile configured in the `[database]` section"""
+    return [
+        ('journal_mode', DatabaseConfig.journal_mode),
+        ('synchronous', DatabaseConfig.synchronous),
+        ('cache_size', DatabaseConfig.cache_size),
+        ('mmap_size', DatabaseConfig.mmap_size)
+    ]
+
+
+# every person column that is filled from a record, so bulk inserts have the same keys for each row
+_PERSON_COLUMNS = dict.fromkeys(code_name for _, code_name in MAPPING_PLAN.row_fields)
+
+
+def _codes(value):
+    """Codes of a comma-separated column"""
+    return [int(code) for code in value.split(',')] if value else []
+
+
+# the Database of this process, created on first access by `get_db` with the arguments of `configure_db`
+_database = None
+_database_pid = None
+_database_args = {}
+_database_lock = threading.Lock()
 
 
 def get_db():
-    return database
+    """Return the Database of this process - created (and the schema with it) on first access, thread-safe"""
+    global _database, _database_pid
+    if _database is None or _database_pid != os.getpid():
+        with _database_lock:
+            # a forked process must not use the connections of its parent
+            if _database is None or _database_pid != os.getpid():
+                _database = Database(**_database_args)
+                _database_pid = os.getpid()
+    return _database
+
+
+def configure_db(db_url=None, pragmas=None):
+    """Set the arguments of the Database that `get_db` returns in this process (e.g. another file in tests),
+    a Database created already is closed"""
+    global _database, _database_args
+    with _database_lock:
+        try:
+            if _database is not None and _database_pid == os.getpid():
+                _database.close()
+        finally:
+            _database = None
+            _database_args = {'db_url': db_url, 'pragmas': pragmas}
+
@@ -1,10 +1,13 @@
-import json
+import logging
+import threading
 
 import requests
 from logzero import logger
 
 from .config import DhisConfig, SMARTVADHIS2_VERSION
+from .helpers import dump_json
 from .mapping import Sid
+from .verbalautopsy import events_body
 
 from .exceptions.base import (
     FileException,
@@ -23,6 +26,14 @@ Module for DHIS2 access and Import Status
 """
 
 
+# description of an import summary in DHIS2 => exception to raise
+IMPORT_FAILURES = (
+    ("Event.orgUnit does not point to a valid organisation unit", OrgunitNotValidImportError),
+    ("Event.program does not point to a valid program", ProgramNotValidError),
+    ("Program is not assigned to this organisation unit", OrgUnitNotAssignedError)
+)
+
+
 class RaiseImportFailure(object):
     """Raise exception if import failed"""
     def __init__(self, response):
@@ -33,11 +44,17 @@ class RaiseImportFailure(object):
             self.updated = int(response['response']['updated'])
             self.ignored = int(response['response']['ignored'])
             self.deleted = int(response['response']['deleted'])
-        except (ValueError, KeyError, TypeError):
+            # UIDs of the events as created by DHIS2
+            self.references = [r.get('reference') for r in response['response'].get('importSummaries', [])]
+        except (ValueError, KeyError, TypeError, AttributeError):
             logger.debug(response)
             raise GenericImportError("Error parsing response: {}".format(response))
 
         else:
+            if self.status_code in {200, 201} and self.imported == 0 and self.updated > 0:
+                # the (deterministic) event UID already existed and was updated instead
+                raise DuplicateEventImportError("Updated existing events {}".format(','.join(
+                    [r for r in self.references if r])))
             if self.status_code not in {200, 201} or self.imported == 0:
                 try:
                     # check if all response state are SUCCESS
@@ -53,15 +70,55 @@ class RaiseImportFailure(object):
                         logger.debug(response)
                         raise GenericImportError(response)
 
-                if [d for d in self.description if "Event.orgUnit does not point to a valid organisation unit" in d]:
-                    raise OrgunitNotValidImportError(self.description)
-                elif [d for d in self.description if "Event.program does not point to a valid program" in d]:
-                    raise ProgramNotValidError(self.description)
-                elif [d for d in self.description if "Program is not assigned to this organisation unit" in d]:
-                    raise OrgUnitNotAssignedError(self.description)
-                else:
-                    logger.debug(response)
-                    raise GenericImportError(response)
+                raise self.categorize(self.description, response)
+
+    @staticmethod
+    def categorize(description, response):
+        """Return the exception matching the descriptions of failed import summaries"""
+        for message, exception in IMPORT_FAILURES:
+            if [d for d in description if message in d]:
+                return exception(description)
+        logger.debug(response)
+        return GenericImportError(response)
+
+    @classmethod
+    def per_event(cls, response, sids, uids=None):
+        """Map every entry in `importSummaries` of a bulk import back to its SID.
+        DHIS2 returns one import summary per event in the order they were sent - if there are more or fewer,
+        they are matched by their `reference` to the event UIDs `uids` that were sent.
+        Success is decided by the import count, as a `WARNING` summary may still have imported the event.
+        Returns a list of (sid, event UID, exception) tuples - exception is None if the event was imported
+        """
+        try:
+            summaries = response['response']['importSummaries']
+            if len(summaries) != len(sids):
+                if uids is None:
+                    raise ValueError
+                by_reference = {summary.get('reference'): summary for summary in summaries}
+                summaries = [by_reference.get(uid) for uid in uids]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.debug(response)
+            return [(sid, None, GenericImportError("Error parsing response: {}".format(response))) for sid in sids]
+
+        results = []
+        for sid, summary in zip(sids, summaries):
+            if summary is None:
+                results.append((sid, None, GenericImportError("No import summary for SID {}".format(sid))))
+                continue
+            count = summary.get('importCount', {})
+            if count.get('imported', 0) > 0:
+                results.append((sid, summary.get('reference'), None))
+                continue
+            if count.get('updated', 0) > 0:
+                message = "Updated existing event {}".format(summary.get('reference'))
+                results.append((sid, summary.get('reference'), DuplicateEventImportError(message)))
+                continue
+            description = set()
+            if summary.get('description'):
+                description.add(summary['description'])
+            description.update(c['value'] for c in summary.get('conflicts', []) if 'value' in c)
+            results.append((sid, None, cls.categorize(description, summary)))
+        return results
 
 
 def raise_if_duplicate(response, sid):
@@ -73,24 +130,62 @@ def raise_if_duplicate(response, sid):
         raise DuplicateEventImportError(message)
 
 
+def raise_if_existing(existing, sid):
+    """Raise if a batched duplicate check (see Dhis.existing_events) found events for this SID"""
+    if sid in existing:
+        event_uids = ','.join(existing[sid])
+        message = '{} events already exist for SID {} in events {}'.format(len(existing[sid]), sid, event_uids)
+        raise DuplicateEventImportError(message)
+
+
+def parse_existing_events(response):
+    """Return a dict of {SID: [event UIDs]} from an events/query response"""
+    existing = {}
+    headers = [h['name'] for h in response.get('headers', [])]
+    try:
+        event_col = headers.index('event')
+        sid_col = headers.index(Sid.dhis_uid)
+    except ValueError:
+        if response.get('rows'):
+            raise DhisApiException("Could not find SID column in response: {}".format(headers))
+        return existing
+    for row in response.get('rows', []):
+        existing.setdefault(row[sid_col], []).append(row[event_col])
+    return existing
+
+
+def normalize_url(url):
+    """Return the DHIS2 base URL with its scheme (http for localhost, https otherwise)"""
+    if '/api' in url:
+        raise FileException('Do not specify /api in the URL')
+    if url.startswith('localhost') or url.startswith('127.0.0.1'):
+        url = 'http://{}'.format(url)
+    elif url.startswith('http://'):
+        url = url
+    elif not url.startswith('https://'):
+        url = 'https://{}'.format(url)
+    return url
+
+
+def events_query_params(root_orgunit, sid_filter):
+    """Parameters for events/query to find events by SID across all OrgUnits"""
+    return {
+        'programStage': DhisConfig.programstage_uid,
+        'orgUnit': root_orgunit,
+        'ouMode': 'DESCENDANTS',
+        'filter': '{}:{}'.format(Sid.dhis_uid, sid_filter)
+    }
+
+
 class Dhis(object):
     """Class for accessing DHIS2"""
     def __init__(self):
 
-        url = DhisConfig.baseurl
+        url = normalize_url(DhisConfig.baseurl)
         api_version = DhisConfig.api_version
 
-        if '/api' in url:
-            raise FileException('Do not specify /api in the URL')
-        if url.startswith('localhost') or url.startswith('127.0.0.1'):
-            url = 'http://{}'.format(url)
-        elif url.startswith('http://'):
-            url = url
-        elif not url.startswith('https://'):
-            url = 'https://{}'.format(url)
-
         self.api_url = '{}/api/{}'.format(url, api_version)
-        self.api = requests.Session()
+        self._local = threading.local()
         self.auth = (DhisConfig.username, DhisConfig.password)
         self.headers = {'User-Agent': 'smartvadhis2_v.{}'.format(SMARTVADHIS2_VERSION)}
         logger.info("Connecting to DHIS2 on {}".format(url))
@@ -98,34 +193,78 @@ class Dhis(object):
         self.root_orgunit = self.root_orgunit()
         self.dhis_version = self.dhis_version()
 
+    @property
+    def api(self):
+        """requests.Session of the current thread - every worker thread gets its own"""
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
     def get(self, endpoint, params=None):
         """DHIS2 HTTP GET, returns requests.Response object"""
         url = '{}/{}.json'.format(self.api_url, endpoint)
-        logger.debug('GET: {} - Params: {}'.format(url, params))
+        logger.debug('GET: %s - Params: %s', url, params)
         return self.api.get(url, params=params, auth=self.auth, headers=self.headers)
 
     def post(self, endpoint, data, params=None):
-        """DHIS2 HTTP POST, returns requests.Response object"""
+        """DHIS2 HTTP POST of a dict or of already encoded JSON bytes, returns requests.Response object"""
         url = '{}/{}'.format(self.api_url, endpoint)
-        logger.debug('POST: {} - Params: {} - Data: {}'.format(url, params, json.dumps(data)))
-        return self.api.post(url, params=params, auth=self.auth, headers=self.headers, json=data)
+        body = data if isinstance(data, bytes) else dump_json(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('POST: %s - Params: %s - Data: %s', url, params, body.decode('utf-8'))
+        headers = dict(self.headers, **{'Content-Type': 'application/json'})
+        return self.api.post(url, params=params, auth=self.auth, headers=headers, data=body)
 
     def delete(self, endpoint):
         """DHIS2 HTTP DELETE, returns requests.Response object"""
         url = '{}/{}'.format(self.api_url, endpoint)
         return self.api.delete(url, auth=self.auth, headers=self.headers)
 
+    @staticmethod
+    def import_params():
+        """Event import parameters - with the duplicate check skipped, DHIS2 updates events with an existing UID"""
+        if DhisConfig.skip_duplicate_check:
+            return {'importStrategy': 'CREATE_AND_UPDATE'}
+        return None
+
     def post_event(self, data):
-        """POST DHIS2 Event"""
-        r = self.post(endpoint='events', data=data)
+        """POST DHIS2 Event (an Event, sent as its encoded body, or a dict) and return the UID of the created event"""
+        body = getattr(data, 'body', data)
+        r = self.post(endpoint='events', data=body, params=self.import_params())
         try:
-            RaiseImportFailure(r.json())
+            status = RaiseImportFailure(r.json())
             r.raise_for_status()
         except OrgUnitNotAssignedError:
-            self.assign_orgunit_to_program(data)
-            self.post(endpoint='events', data=data)
+            self.assign_orgunit_to_program(getattr(data, 'payload', data))
+            r = self.post(endpoint='events', data=body, params=self.import_params())
+            status = RaiseImportFailure(r.json())
         except requests.RequestException:
             raise DhisApiException("POST failed - {} {}".format(r.url, r.text))
+        return status.references[0] if status.references else None
+
+    def post_events(self, events):
+        """POST a chunk of DHIS2 Events in one request (bulk import)
+        Returns a list of (sid, event UID, exception) tuples - exception is None if the event was imported
+        """
+        results = self._post_events(events)
+
+        # assign orgunits to the program and re-post only those events that failed for it
+        not_assigned = {sid for sid, _, exc in results if isinstance(exc, OrgUnitNotAssignedError)}
+        if not_assigned:
+            retry = [e for e in events if e.sid in not_assigned]
+            for orgunit in {e.orgunit for e in retry}:
+                self.assign_orgunit_to_program({'orgUnit': orgunit})
+            retried = {result[0]: result for result in self._post_events(retry)}
+            results = [retried.get(result[0], result) for result in results]
+        return results
+
+    def _post_events(self, events):
+        r = self.post(endpoint='events', data=events_body(events), params=self.import_params())
+        try:
+            response = r.json()
+        except ValueError:
+            response = r.text
+        return RaiseImportFailure.per_event(response, [e.sid for e in events], [e.uid for e in events])
 
     def dhis_version(self):
         """
@@ -145,15 +284,26 @@ class Dhis(object):
 
     def is_duplicate(self, sid):
         """Check DHIS2 for a duplicate event by SID across all OrgUnits"""
-        params = {
-            'programStage': DhisConfig.programstage_uid,
-            'orgUnit': self.root_orgunit,
-            'ouMode': 'DESCENDANTS',
-            'filter': '{}:EQ:{}'.format(Sid.dhis_uid, sid)
-        }
+        params = events_query_params(self.root_orgunit, 'EQ:{}'.format(sid))
         r = self.get(endpoint='events/query', params=params)
         raise_if_duplicate(r.json(), sid)
 
+    def existing_events(self, sids, chunk_size=None):
+        """Check DHIS2 for existing events of many SIDs (e.g. of a whole SmartVA file) across all OrgUnits
+        by querying them in chunks with an IN filter.
+        Returns a dict of {SID: [event UIDs]} for those SIDs that already exist
+        """
+        chunk_size = chunk_size or DhisConfig.duplicate_check_chunk_size
+        sids = sorted(set(sids))
+        existing = {}
+        for i in range(0, len(sids), chunk_size):
+            params = events_query_params(self.root_orgunit, 'IN:{}'.format(';'.join(sids[i:i + chunk_size])))
+            params['skipPaging'] = 'true'
+            r = self.get(endpoint='events/query', params=params)
+            for sid, event_uids in parse_existing_events(r.json()).items():
+                existing.setdefault(sid, []).extend(event_uids)
+        return existing
+
     def root_orgunit(self):
         params = {
             'fields': 'id',
@@ -183,4 +333,4 @@ class Dhis(object):
         if org_unit not in [ou['id'] for ou in existing['organisationUnits']]:
             existing['organisationUnits'].append({"id": org_unit})
             self.post('metadata', data={'programs': [existing]})
-            logger.info("Assigned orgUnit {}".format(org_unit))
+            logger.info("Assigned orgUnit %s", org_unit)
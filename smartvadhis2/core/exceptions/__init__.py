@@ -3,3 +3,6 @@ from .errors import *
 from .warnings import *
 
 db_exceptions = ImportException.__subclasses__() + ValidationError.__subclasses__() + ValidationWarning.__subclasses__()
+
+# validation errors and warnings by their code, e.g. to re-create them from codes sent by another process
+validation_exceptions = {e.code: e for e in ValidationError.__subclasses__() + ValidationWarning.__subclasses__()}
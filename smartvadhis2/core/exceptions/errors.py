@@ -190,6 +190,15 @@ class OrgUnitNotAssignedError(ImportException):
         super(ImportException, self).__init__("{}: {}".format(self.message, response), self.code)
 
 
+class DuplicateSidInFileError(ImportException):
+    message = "Record for VA.SID superseded by another record of the same file"
+    code = 706
+    err_type = 'IMPORT'
+
+    def __init__(self, response):
+        super(ImportException, self).__init__("{}: {}".format(self.message, response), self.code)
+
+
 __all__ = [
     'ValidationError',
     'BirthDateParseError',
@@ -210,5 +219,6 @@ __all__ = [
     'ProgramNotValidError',
     'GenericImportError',
     'DuplicateEventImportError',
-    'OrgUnitNotAssignedError'
+    'OrgUnitNotAssignedError',
+    'DuplicateSidInFileError'
 ]
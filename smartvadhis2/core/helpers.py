@@ -1,11 +1,24 @@
+import calendar
 import csv
 import datetime
+import hashlib
+import itertools
+import json
+import operator
 import os
 import re
+import string
+from array import array
+from functools import lru_cache
 
 from .config import SmartVAConfig
 from .exceptions import FileException
-from .mapping import Mapping
+from .mapping import MAPPING_PLAN
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 """
 Module that provides various helper methods cross all other modules
@@ -22,29 +35,178 @@ class Color:
     END = '\033[0m'
 
 
-def read_csv(path):
-    """Generator to read a smartva CSV file"""
-    allowed_fields = [m.csv_name for m in Mapping.properties() if m.csv_name is not None]
-    with open(path, 'r') as f:
-        reader = csv.DictReader(f, delimiter=',')
+def read_csv(path, with_progress=False, mapped_only=False, digest=None):
+    """Generator to read a smartva CSV file in a single pass
+    with_progress: yield tuples of (row, percentage of the file read) instead, based on the byte offset
+    mapped_only: yield a MappedRow with only the columns of the Mapping instead of a dict of all columns
+    digest: a hashlib object updated with the bytes read, e.g. to get the `file_hash` in the same pass
+    """
+    allowed_fields = MAPPING_PLAN.csv_names.union(SmartVAConfig.ignore_columns)
+    size = os.path.getsize(path) or 1
+    with open(path, 'rb') as f:
+        offset = [0]
+
+        def lines():
+            for line in f:
+                offset[0] += len(line)
+                if digest is not None:
+                    digest.update(line)
+                yield line.decode('utf-8')
+
+        source = lines()
+        header = next(csv.reader(source, delimiter=','), [])
 
-        for field in reader.fieldnames:
-            if field not in allowed_fields and field not in SmartVAConfig.ignore_columns:
+        for field in header:
+            if field not in allowed_fields:
                 raise FileException("Column '{}' could not be parsed - check Mapping and SmartVA CSV. "
                                     "Ignored columns per config: {}".format(field,
                                                                             ','.join(SmartVAConfig.ignore_columns)))
-        for row in reader:
-            yield row
+        if mapped_only:
+            rows = _mapped_rows(csv.reader(source, delimiter=','), header)
+        else:
+            rows = csv.DictReader(source, fieldnames=header, delimiter=',')
+
+        for row in rows:
+            if with_progress:
+                yield row, 100.0 * offset[0] / size
+            else:
+                yield row
+
+
+class _NotInHeader(object):
+    """Value of a MappedRow for a column of the Mapping that is not in the header of the file"""
+    __slots__ = ()
+
+    def __reduce__(self):
+        # unpickled as the same object
+        return 'NOT_IN_HEADER'
+
+    def __repr__(self):
+        return 'NOT_IN_HEADER'
+
+
+NOT_IN_HEADER = _NotInHeader()
+
+
+def _mapped_rows(reader, header):
+    """Pick the columns of the Mapping from the rows of a csv.reader by their index in the header"""
+    positions = {name: i for i, name in enumerate(header)}
+    width = len(header)
+    # columns missing from the file point behind the end of the row, to NOT_IN_HEADER
+    indexes = [positions.get(name, width) for name in MAPPING_PLAN.csv_fields]
+    pick = operator.itemgetter(*indexes)
+    new = tuple.__new__
+    for row in reader:
+        if len(row) != width:
+            # like csv.DictReader, short rows are padded with None and values without a column are dropped
+            del row[width:]
+            row.extend([None] * (width - len(row)))
+        row.append(NOT_IN_HEADER)
+        yield new(MappedRow, pick(row))
+
+
+class MappedRow(tuple):
+    """A row of a SmartVA CSV file holding only the columns of the Mapping, in the order of MAPPING_PLAN.csv_fields.
+    Read like the dict of csv.DictReader - `row['sid']`, `row.get('sid')` - a column missing from the file is not set,
+    a column missing from a short row is None
+    """
+    __slots__ = ()
+    _positions = {name: i for i, name in enumerate(MAPPING_PLAN.csv_fields)}
+
+    def __getitem__(self, name):
+        value = tuple.__getitem__(self, self._positions[name])
+        if value is NOT_IN_HEADER:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        position = self._positions.get(name)
+        if position is None:
+            return default
+        value = tuple.__getitem__(self, position)
+        return default if value is NOT_IN_HEADER else value
+
+    def __contains__(self, name):
+        return self.get(name, NOT_IN_HEADER) is not NOT_IN_HEADER
+
+    def keys(self):
+        return [name for name, value in zip(MAPPING_PLAN.csv_fields, self) if value is not NOT_IN_HEADER]
+
+    def items(self):
+        return [(name, value) for name, value in zip(MAPPING_PLAN.csv_fields, self) if value is not NOT_IN_HEADER]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class DictionaryColumn(object):
+    """A column stored as its distinct values and, for every row, the index of its value (dictionary encoding)"""
+    __slots__ = ('values', 'codes', '_index')
+
+    def __init__(self):
+        self.values = []
+        self.codes = array('i')
+        self._index = {}
+
+    @classmethod
+    def encode(cls, values):
+        column = cls()
+        for value in values:
+            column.append(value)
+        return column
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+
+def read_columns(path, names=None):
+    """Read a smartva CSV file into a dict of {column name: DictionaryColumn}
+    names: columns to keep, defaults to all columns of the Mapping
+    """
+    names = MAPPING_PLAN.csv_names if names is None else names
+    columns = {name: DictionaryColumn() for name in names}
+    for row in read_csv(path, mapped_only=MAPPING_PLAN.csv_names.issuperset(names)):
+        for name, column in columns.items():
+            column.append(row.get(name))
+    return columns
 
 
 def csv_with_content(fpath):
     """Return true if file exists AND file has more than 1 row, false otherwise"""
     if fpath and os.path.exists(fpath):
-        row_count = sum(1 for line in open(fpath))
+        with open(fpath, 'r') as f:
+            # only peek at the first two lines
+            row_count = sum(1 for _ in itertools.islice(f, 2))
         return row_count > 1
     return False
 
 
+def dump_json(obj):
+    """Return obj encoded as compact JSON in UTF-8 bytes - with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
 def sanitize(data, some_property):
     """Strip whitespace from a dict value"""
     value = data.get(some_property, '')
@@ -56,6 +218,61 @@ def is_uid(string):
     return re.compile('^[A-Za-z][A-Za-z0-9]{10}$').match(string)
 
 
+def deterministic_uid(*seeds):
+    """Return a valid DHIS2 UID that is always the same for the same seeds (e.g. program UID and SID)"""
+    digest = hashlib.sha256(':'.join(seeds).encode('utf-8')).digest()
+    alphanumeric = string.ascii_letters + string.digits
+    # first character must be a letter, the other 10 letters or digits
+    return string.ascii_letters[digest[0] % len(string.ascii_letters)] + \
+        ''.join(alphanumeric[b % len(alphanumeric)] for b in digest[1:11])
+
+
+# number of distinct date strings kept parsed
+DATE_CACHE_SIZE = 4096
+DATE_FMT = '%Y-%m-%d'
+ISO_DATE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})\Z')
+# ODK date, e.g. 'Mar 26, 2018'
+ODK_DATE = re.compile(r'([A-Za-z]{3}) ([0-9]{1,2}), ([0-9]{4})\Z')
+MONTH_ABBR = {calendar.month_abbr[i].lower(): i for i in range(1, 13)}
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def iso_date(value):
+    """Return an ISO 8601 date (e.g. '2018-03-26') as 'YYYY-MM-DD' or None if it is not valid.
+    Same result as strptime/strftime with '%Y-%m-%d', which is only called for unusual values (e.g. '2018-3-26')
+    """
+    match = ISO_DATE.match(value)
+    if match and value[0] != '0':
+        try:
+            datetime.date(*[int(g) for g in match.groups()])
+        except ValueError:
+            return None
+        return value
+    return _strptime_date(value, DATE_FMT)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def odk_date(value):
+    """Return an ODK date (e.g. 'Mar 26, 2018') as 'YYYY-MM-DD' or None if it is not valid.
+    Same result as strptime/strftime with '%b %d, %Y', which is only called for unusual values
+    """
+    match = ODK_DATE.match(value)
+    if match and match.group(1).lower() in MONTH_ABBR and match.group(3)[0] != '0':
+        month, day, year = MONTH_ABBR[match.group(1).lower()], int(match.group(2)), int(match.group(3))
+        try:
+            return datetime.date(year, month, day).strftime(DATE_FMT)
+        except ValueError:
+            return None
+    return _strptime_date(value, '%b %d, %Y')
+
+
+def _strptime_date(value, fmt):
+    try:
+        return datetime.datetime.strptime(value, fmt).strftime(DATE_FMT)
+    except ValueError:
+        return None
+
+
 def get_timewindow(weeks=-1, days=0, fmt='%Y/%m/%d'):
     """Return tuple of datetime strings
     ODK Briefcase is inclusive: https://github.com/opendatakit/briefcase/issues/159
@@ -309,3 +309,23 @@ def cause_of_death_option_code(age_category, icd10):
         # if ICD-10 is the option (e.g. 35)
         original_code_lookup = Icd10.reverse[icd10]
         return CauseOfDeath.options[age_category][original_code_lookup]
+
+
+class MappingPlan(object):
+    """The Mapping properties compiled once into the tuples that are iterated for every record"""
+    def __init__(self, properties):
+        csv_properties = [m for m in properties if m.csv_name is not None]
+        # (csv_name, code_name) in the order VerbalAutopsy attributes are set: by `set_order`, then by `code_name`
+        self.row_fields = tuple(
+            (m.csv_name, m.code_name) for m in sorted(csv_properties, key=lambda m: (m.set_order, m.code_name))
+        )
+        self.csv_names = frozenset(m.csv_name for m in csv_properties)
+        # the CSV columns of the Mapping in alphabetical order, the fields of a helpers.MappedRow
+        self.csv_fields = tuple(sorted(self.csv_names))
+        # all code names in alphabetical order, the fields of a VerbalAutopsy
+        self.code_names = tuple(sorted(m.code_name for m in properties))
+        # (code_name, dhis_uid) of properties imported into DHIS2 as data values
+        self.dhis_fields = tuple((m.code_name, m.dhis_uid) for m in properties if m.code_name and m.dhis_uid)
+
+
+MAPPING_PLAN = MappingPlan(Mapping.properties())
@@ -48,3 +48,36 @@ class PersonFailure(Base):
     failureid = Column(Integer, ForeignKey(Failure.failureid), primary_key=True)
     created = Column(DateTime, default=datetime.now)
 
+
+class ImportedEvent(Base):
+    """ImportedEvent model, a ledger of every SID that was imported successfully into DHIS2"""
+    __tablename__ = "imported_event"
+    sid = Column(String, primary_key=True)
+    event = Column(String)
+    created = Column(DateTime, default=datetime.now)
+
+
+class Checkpoint(Base):
+    """Checkpoint model, progress of a SmartVA file to resume interrupted runs"""
+    __tablename__ = "checkpoint"
+    filehash = Column(String, primary_key=True)
+    filename = Column(String)
+    lastrow = Column(Integer, default=0)
+    records = Column(Integer, default=0)
+    imported = Column(Integer, default=0)
+    duplicates = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    created = Column(DateTime, default=datetime.now)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class ValidationFailure(Base):
+    """ValidationFailure model, the validation result of a SmartVA row that failed validation,
+    keyed by the hash of its mapped fields and the configuration the validation depends on"""
+    __tablename__ = "validation_failure"
+    rowhash = Column(String, primary_key=True)
+    sid = Column(String)
+    # comma-separated codes of the ValidationErrors and ValidationWarnings
+    errors = Column(String)
+    warnings = Column(String)
+    created = Column(DateTime, default=datetime.now)
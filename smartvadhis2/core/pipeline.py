@@ -0,0 +1,136 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+"""
+Module for processing items in stages connected by bounded queues (producer/consumer)
+"""
+
+# marks the end of the items passed between stages
+_END = object()
+
+# seconds to wait on a queue before checking if the pipeline was stopped
+_POLL = 0.1
+
+
+class Stage(object):
+    """A step of a Pipeline: `func` is called with every item in up to `workers` threads.
+    Results are passed on in the order of the items - a stage with one worker runs `func` in order.
+    """
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+
+
+class Pipeline(object):
+    """Pass the items of a source through stages, each running in its own thread(s).
+    Stages are connected by queues of `queue_size` items - a stage waits while the next one is busy (backpressure),
+    so memory is bounded by the queue sizes no matter how many items the source yields.
+    Iterating over `run(source)` yields the results of the last stage in order.
+    An exception in the source or a stage is raised there and stops all stages.
+    """
+    def __init__(self, stages, queue_size):
+        self.stages = stages
+        self.queue_size = max(queue_size, 1)
+        self._stopped = threading.Event()
+
+    def run(self, source):
+        self._stopped.clear()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._read, args=(source, queues[0]), name='pipeline-read')]
+        for stage, inbox, outbox in zip(self.stages, queues, queues[1:]):
+            threads.append(threading.Thread(target=self._work, args=(stage, inbox, outbox),
+                                            name='pipeline-{}'.format(stage.name)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                future = self._get(queues[-1])
+                if future is _END:
+                    break
+                yield future.result()
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _read(self, source, outbox):
+        """Put the items of the source into the first queue"""
+        try:
+            for item in source:
+                if not self._put(outbox, _done(item)):
+                    return
+        except BaseException as e:
+            self._put(outbox, _failed(e))
+        self._put(outbox, _END)
+
+    def _work(self, stage, inbox, outbox):
+        """Call the stage for every item of its inbox and put the futures of the results in order into the outbox"""
+        pool = ThreadPoolExecutor(max_workers=stage.workers) if stage.workers > 1 else None
+        submitted = []
+        try:
+            while True:
+                future = self._get(inbox)
+                if future is _END:
+                    break
+                if future.exception() is not None:
+                    # pass the failure on to the consumer of the last stage
+                    result = future
+                elif pool:
+                    result = pool.submit(stage.func, future.result())
+                    submitted = [f for f in submitted if not f.done()] + [result]
+                else:
+                    result = _call(stage.func, future.result())
+                if not self._put(outbox, result):
+                    break
+        except BaseException as e:
+            # never end the items of a stage silently
+            self._put(outbox, _failed(e))
+        finally:
+            if pool:
+                if self._stopped.is_set():
+                    # do not start pending work of a stopped pipeline
+                    for f in submitted:
+                        f.cancel()
+                pool.shutdown(wait=True)
+            self._put(outbox, _END)
+
+    def _get(self, inbox):
+        while not self._stopped.is_set():
+            try:
+                return inbox.get(timeout=_POLL)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _put(self, outbox, item):
+        """Put an item once there is space in the queue - returns False if the pipeline was stopped"""
+        while not self._stopped.is_set():
+            try:
+                outbox.put(item, timeout=_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _failed(exception):
+    future = Future()
+    future.set_exception(exception)
+    return future
+
+
+def _call(func, item):
+    try:
+        return _done(func(item))
+    except BaseException as e:
+        return _failed(e)
@@ -1,7 +1,9 @@
+import hashlib
 import json
 import re
 from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 
 from logzero import logger
 
@@ -21,6 +23,7 @@ from .exceptions.errors import (
     OrgunitMissingError,
     OrgunitNotValidError
 )
+from .exceptions import validation_exceptions
 from .exceptions.warnings import (
     ValidationWarning,
     AgeMissingWarning,
@@ -30,10 +33,25 @@ from .exceptions.warnings import (
     InterviewDateMissingWarning,
     InterviewDateParseWarning
 )
-from .helpers import sanitize, is_uid, years_to_days
-from .mapping import Mapping, Sex, AgeCategory, Icd10, cause_of_death_option_code
+from .helpers import (
+    sanitize,
+    is_uid,
+    years_to_days,
+    deterministic_uid,
+    iso_date,
+    odk_date,
+    dump_json,
+    DictionaryColumn,
+    DATE_FMT
+)
+from .mapping import MAPPING_PLAN, Sex, AgeCategory, Icd10, cause_of_death_option_code
 from ..__version__ import __version__
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 """
 Module for Verbal Autopsy
@@ -43,18 +61,10 @@ Module for Verbal Autopsy
 def process_row_data(data):
     """
     Process row data
-    first get the one we need to add those properties whose `set_order` (see mapping.py) start with 0, then 1, ...
-    and sort it alphabetically by key
+    properties are ordered by their `set_order` (see mapping.py) so dependants are set later,
+    then alphabetically by key
     """
-    row_data = OrderedDict()
-    for i in Mapping.set_order_range():
-        # get row based on mapping properties and sort it alphabetically
-        row_data.update(sorted({
-            mapping.code_name: sanitize(data, mapping.csv_name)
-            for mapping in Mapping.properties()
-            if mapping.set_order == i and mapping.csv_name is not None
-        }.items(), key=lambda t: t[0]))
-    return row_data
+    return OrderedDict((code_name, sanitize(data, csv_name)) for csv_name, code_name in MAPPING_PLAN.row_fields)
 
 
 def verbal_autopsy_factory(data):
@@ -63,31 +73,125 @@ def verbal_autopsy_factory(data):
     and collect all validation exceptions and warnings
     return VerbalAutopsy, its exceptions and its warnings as a tuple
     """
-    row_data = process_row_data(data)
-
     va = VerbalAutopsy()
     exceptions = []
     warnings = []
 
     # set CSV row attributes
-    for k, v in row_data.items():
+    for csv_name, setter in _ROW_SETTERS:
         try:
-            setattr(va, k, v)
-            va.algorithm_version = SmartVAConfig.algorithm_version
-            va.questionnaire_version = ODKConfig.form_id
+            setter(va, sanitize(data, csv_name))
         except ValidationError as e:
             exceptions.append(e)
         except ValidationWarning as e:
             warnings.append(e)
+    va.algorithm_version = SmartVAConfig.algorithm_version
+    va.questionnaire_version = ODKConfig.form_id
 
     return va, exceptions, warnings
 
 
+def validation_hash(data):
+    """
+    Hash of the mapped CSV fields of a record and the configuration its validation depends on
+    - records with the same hash have the same validation errors and warnings
+    """
+    values = [ODKConfig.sid_regex, ODKConfig.form_id, SmartVAConfig.algorithm_version, __version__]
+    values.extend(sanitize(data, csv_name) or '' for csv_name, _ in MAPPING_PLAN.row_fields)
+    return hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+def validate_compact(records):
+    """
+    Validate many records, e.g. in a worker process of a ProcessPoolExecutor.
+    Returns a compact, picklable (VerbalAutopsy state, error codes, warning codes) tuple per record
+    - see `verbal_autopsy_from_compact`
+    """
+    compact = []
+    for record in records:
+        va, exceptions, warnings = verbal_autopsy_factory(record)
+        compact.append((va.state(), [e.code for e in exceptions], [w.code for w in warnings]))
+    return compact
+
+
+def verbal_autopsy_from_compact(state, error_codes, warning_codes):
+    """Re-create the result of `verbal_autopsy_factory` from a tuple returned by `validate_compact`"""
+    va = VerbalAutopsy.from_state(state)
+    return va, [validation_exceptions[c]() for c in error_codes], [validation_exceptions[c]() for c in warning_codes]
+
+
+# validation error and warning codes are bits of the masks returned by `validate_batch`: bit = code - base
+ERROR_BASE = 600
+WARNING_BASE = 800
+
+
+def validate_batch(columns):
+    """
+    Validate a whole SmartVA file given as columns: a dict of {csv_name: DictionaryColumn or list of values}
+    (see helpers.read_columns). The rules of the VerbalAutopsy setters run once per distinct value of a column
+    and are spread to its rows with NumPy if it is installed.
+    Returns two sequences of per-row bitmasks, errors and warnings - see `mask_codes`
+    """
+    length = max(len(column) for column in columns.values())
+    if numpy is not None:
+        errors = numpy.zeros(length, dtype=numpy.uint16)
+        warnings = numpy.zeros(length, dtype=numpy.uint16)
+    else:
+        errors = [0] * length
+        warnings = [0] * length
+
+    for csv_name, setter in _ROW_SETTERS:
+        column = columns.get(csv_name)
+        if column is None:
+            # a column missing in the file is empty for all rows
+            column = DictionaryColumn.encode([None] * length)
+        elif not isinstance(column, DictionaryColumn):
+            column = DictionaryColumn.encode(column)
+
+        value_errors = []
+        value_warnings = []
+        va = VerbalAutopsy()
+        for value in column.values:
+            error, warning = 0, 0
+            try:
+                # stripped like `sanitize`
+                setter(va, (value.strip() or None) if value else None)
+            except ValidationError as e:
+                error = 1 << (e.code - ERROR_BASE)
+            except ValidationWarning as w:
+                warning = 1 << (w.code - WARNING_BASE)
+            value_errors.append(error)
+            value_warnings.append(warning)
+
+        if numpy is not None:
+            # array('i') of C ints, read without copying
+            codes = numpy.frombuffer(column.codes, dtype=numpy.intc)
+            if any(value_errors):
+                errors |= numpy.asarray(value_errors, dtype=numpy.uint16)[codes]
+            if any(value_warnings):
+                warnings |= numpy.asarray(value_warnings, dtype=numpy.uint16)[codes]
+        else:
+            if any(value_errors):
+                errors = [mask | value_errors[code] for mask, code in zip(errors, column.codes)]
+            if any(value_warnings):
+                warnings = [mask | value_warnings[code] for mask, code in zip(warnings, column.codes)]
+
+    return errors, warnings
+
+
+def mask_codes(mask, base):
+    """Return the validation codes set in a bitmask of `validate_batch`, e.g. mask_codes(errors[0], ERROR_BASE)"""
+    mask = int(mask)
+    return [base + bit for bit in range(mask.bit_length()) if mask >> bit & 1]
+
+
 class VerbalAutopsy(object):
     """
     Base class for Verbal Autopsy that utilizes Python's @property decorators
     implemented as class whose attributes can be accessed both as keys and attributes.
+    Its fields are the code names of the Mapping, stored in slots instead of a per-instance __dict__.
     """
+    __slots__ = tuple('_{}'.format(code_name) for code_name in MAPPING_PLAN.code_names)
 
     def __getitem__(self, item):
         """If va.attribute is set, va['attribute'] should return the same"""
@@ -102,7 +206,19 @@ class VerbalAutopsy(object):
         return None
 
     def keys(self):
-        return [k for k in dir(self) if not k.startswith('_') and not callable(self[k])]
+        return MAPPING_PLAN.code_names
+
+    def state(self):
+        """Return the values of all slots (None if not set), e.g. to send it to another process"""
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    @classmethod
+    def from_state(cls, state):
+        """Re-create a VerbalAutopsy from `state()`"""
+        va = cls()
+        for slot, value in zip(cls.__slots__, state):
+            setattr(va, slot, value)
+        return va
 
     def __str__(self):
         """Print VerbalAutopsy instance as JSON"""
@@ -143,8 +259,19 @@ class VerbalAutopsy(object):
     def age_category(self, value):
         self._age_category = value
 
+    @property
+    def cause_code(self):
+        return self._cause_code
+
+    @cause_code.setter
+    def cause_code(self, value):
+        self._cause_code = value
+
     @property
     def cause_of_death(self):
+        if self._age_category is None or self._icd10 is None:
+            # not valid - age or ICD-10 could not be parsed
+            return None
         try:
             return cause_of_death_option_code(self._age_category, self._icd10)
         except KeyError:
@@ -156,14 +283,11 @@ class VerbalAutopsy(object):
 
     @birth_date.setter
     def birth_date(self, birth_date):
-        DATE_FMT = '%Y-%m-%d'
         if birth_date:
-            try:
-                d = datetime.strptime(birth_date, DATE_FMT)
-            except ValueError:
+            d = iso_date(birth_date)
+            if d is None:
                 raise BirthDateParseError()
-            else:
-                self._birth_date = d.strftime(DATE_FMT)
+            self._birth_date = d
         else:
             raise BirthDateMissingWarning()
 
@@ -173,14 +297,11 @@ class VerbalAutopsy(object):
 
     @death_date.setter
     def death_date(self, death_date):
-        DATE_FMT = '%Y-%m-%d'
         if death_date:
-            try:
-                d = datetime.strptime(death_date, DATE_FMT)
-            except ValueError:
+            d = iso_date(death_date)
+            if d is None:
                 raise DeathDateParseError()
-            else:
-                self._death_date = d.strftime(DATE_FMT)
+            self._death_date = d
         elif self._interview_date:
             self._death_date = self._interview_date
         else:
@@ -192,18 +313,12 @@ class VerbalAutopsy(object):
 
     @interview_date.setter
     def interview_date(self, interview_date):
-        DATE_FMT_1 = '%Y-%m-%d'
-        DATE_FMT_2 = '%b %d, %Y'  # corresponds to 'Mar 26, 2018' on the locale expression of the Month (e.g. Jan)
         if interview_date:
-            try:
-                d = datetime.strptime(interview_date, DATE_FMT_1)
-                self._interview_date = d.strftime(DATE_FMT_1)
-            except ValueError:
-                try:
-                    d = datetime.strptime(interview_date, DATE_FMT_2)
-                    self._interview_date = d.strftime(DATE_FMT_1)
-                except ValueError:
-                    raise InterviewDateParseWarning()
+            # ISO 8601 or 'Mar 26, 2018' on the locale expression of the Month (e.g. Jan)
+            d = iso_date(interview_date) or odk_date(interview_date)
+            if d is None:
+                raise InterviewDateParseWarning()
+            self._interview_date = d
         else:
             raise InterviewDateMissingWarning()
 
@@ -331,6 +446,27 @@ class VerbalAutopsy(object):
         self._questionnaire_version = ODKConfig.form_id
 
 
+def _setter(code_name):
+    """Return the setter (and validator) of a VerbalAutopsy property"""
+    prop = getattr(VerbalAutopsy, code_name, None)
+    if isinstance(prop, property) and prop.fset:
+        return prop.fset
+    return lambda va, value: setattr(va, code_name, value)
+
+
+def _getter(code_name):
+    """Return the getter of a VerbalAutopsy property"""
+    prop = getattr(VerbalAutopsy, code_name, None)
+    if isinstance(prop, property):
+        return prop.fget
+    return lambda va: va[code_name]
+
+
+# resolved once from MAPPING_PLAN instead of looking up the Mapping classes and properties for every record
+_ROW_SETTERS = tuple((csv_name, _setter(code_name)) for csv_name, code_name in MAPPING_PLAN.row_fields)
+_DATAVALUE_GETTERS = tuple((dhis_uid, _getter(code_name)) for code_name, dhis_uid in MAPPING_PLAN.dhis_fields)
+
+
 class Event(object):
     """Class that transforms a VerbalAutopsy Instance to a DHIS2 Event"""
 
@@ -338,19 +474,33 @@ class Event(object):
         if not isinstance(va, VerbalAutopsy):
             raise ValueError("Cannot process objects of type {}".format(type(va)))
         self.program = DhisConfig.program_uid
+        self.sid = va.sid
+        # the same SID always results in the same event UID, so importing it again does not create another event
+        self.uid = deterministic_uid(self.program, self.sid)
         self.orgunit = va.orgunit
         self.datavalues = va
         self.event_date = va.death_date
 
-        self.payload = {
-            "program": self.program,
+        # the JSON of the event, encoded once (e.g. in a validation thread) for the request body and logging
+        envelope = event_envelope(self.program)[1]
+        self.body = envelope + b',' + dump_json(self._fields())[1:]
+
+    def _fields(self):
+        """The fields that differ from event to event"""
+        return {
+            "event": self.uid,
             "orgUnit": self.orgunit,
             "eventDate": self.event_date,
-            "status": "COMPLETED",
-            "storedBy": "smartvadhis2_v{}".format(__version__),
             "dataValues": self.datavalues
         }
 
+    @property
+    def payload(self):
+        """The event as dict"""
+        payload = dict(event_envelope(self.program)[0])
+        payload.update(self._fields())
+        return payload
+
     @property
     def datavalues(self):
         return self._datavalues
@@ -364,14 +514,29 @@ class Event(object):
         """
         self._datavalues = [
             {
-                "dataElement": mapping.dhis_uid,
-                "value": va[mapping.code_name]
+                "dataElement": dhis_uid,
+                "value": value
             }
-            for mapping in Mapping.properties()
-            if all([mapping.code_name, mapping.dhis_uid])
-            and va[mapping.code_name] is not None
+            for dhis_uid, value in ((dhis_uid, getter(va)) for dhis_uid, getter in _DATAVALUE_GETTERS)
+            if value is not None
         ]
 
     def __str__(self):
         """Print Event instance as JSON"""
-        return json.dumps(self.payload)
+        return self.body.decode('utf-8')
+
+
+@lru_cache(maxsize=None)
+def event_envelope(program):
+    """The fields all events of a program have in common, as dict and as JSON of an object that is not closed yet"""
+    fields = {
+        "program": program,
+        "status": "COMPLETED",
+        "storedBy": "smartvadhis2_v{}".format(__version__)
+    }
+    return fields, dump_json(fields)[:-1]
+
+
+def events_body(events):
+    """The JSON of a bulk import of events, joined from their encoded bodies"""
+    return b'{"events":[' + b','.join(event.body for event in events) + b']}'
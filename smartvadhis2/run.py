@@ -1,15 +1,34 @@
 import argparse
+import asyncio
+import hashlib
+import logging
+import multiprocessing
 import os
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 from logzero import logger
 
-from .core.config import setup, access, DatabaseConfig
-from .core.exceptions.errors import ImportException, DuplicateEventImportError
-from .core.helpers import read_csv, csv_with_content, get_timewindow
-from .core.verbalautopsy import Event, verbal_autopsy_factory
+from .core.aiodhis import AsyncDhis
+from .core.config import setup, access, DatabaseConfig, DhisConfig, PipelineConfig
+from .core.dhis import raise_if_existing
+from .core.exceptions import validation_exceptions
+from .core.exceptions.errors import ImportException, DuplicateEventImportError, DuplicateSidInFileError
+from .core.helpers import read_csv, csv_with_content, get_timewindow, sanitize, file_hash, iso_date, odk_date
+from .core.mapping import Sid, InterviewDate
+from .core.pipeline import Pipeline, Stage
+from .core.verbalautopsy import (
+    Event,
+    verbal_autopsy_factory,
+    validate_compact,
+    verbal_autopsy_from_compact,
+    validation_hash
+)
 
 
 def _parse_args(args=sys.argv[1:]):
@@ -67,6 +86,9 @@ def _run(manual, download_all):
     """
     dhis, briefcase, smartva, db = access()
 
+    if not manual:
+        _resume_interrupted(dhis, db)
+
     # if manual briefcase was provided
     if manual:
         smartva_file = smartva.run(manual, manual=True)
@@ -79,54 +101,575 @@ def _run(manual, download_all):
         else:
             os.remove(briefcase_file)
 
-    success_count, error_count, duplicate_count, no_of_records = 0, 0, 0, 0
     if csv_with_content(smartva_file):
-        no_of_records = sum(1 for _ in read_csv(smartva_file))
-
-        for index, record in enumerate(read_csv(smartva_file), 1):
-            logger.info("[{0}/{1}] SID: {2}".format(index, no_of_records, record.get('sid')))
-            logger.debug("Parsed from CSV: {}".format(record))
-            va, exc, warnings = verbal_autopsy_factory(record)
-            logger.debug("VA data: {}".format(va))
-
-            if warnings:
-                [logger.warn(w) for w in warnings]
-
-            if exc:
-                [logger.error(e) for e in exc]
-                db.write_errors(record, exc)
-                error_count += 1
-            else:
-                event = Event(va)
-                try:
-                    dhis.is_duplicate(va.sid)
-                except DuplicateEventImportError as e:
-                    logger.warning("Record for ID {} already exists in DHIS2".format(record.get('sid')))
-                    db.write_errors(record, e)
-                    duplicate_count += 1
-                else:
-                    try:
-                        dhis.post_event(event.payload)
-                    except ImportException as e:
-                        logger.exception("{}\nfor payload {}".format(e, event.payload))
-                        db.write_errors(record, e)
-                        error_count += 1
-                    else:
-                        logger.info("Import successful!")
-                        success_count += 1
-
-        logger.info("SUMMARY: Parsed ODK records: {} | "
-                    "Imported: {} | "
-                    "Duplicates: {} | "
-                    "Errors: {}".format(
-                        no_of_records,
-                        success_count,
-                        duplicate_count,
-                        error_count))
+        _import_file(smartva_file, dhis, db)
     else:
         logger.warning("No new ODK records to process for time window {} - {}".format(*get_timewindow()))
 
 
+def _import_file(smartva_file, dhis, db):
+    """Import a SmartVA file with the configured engine and log its summary"""
+    if DhisConfig.engine == 'asyncio':
+        summary = _run_async(_import_async(smartva_file, dhis, db))
+    else:
+        summary = _import(smartva_file, dhis, db)
+
+    logger.info("SUMMARY: Parsed ODK records: {} | "
+                "Imported: {} | "
+                "Duplicates: {} | "
+                "Errors: {}".format(
+                    summary.records,
+                    summary.imported,
+                    summary.duplicates,
+                    summary.errors))
+
+
+def _resume_interrupted(dhis, db):
+    """Finish SmartVA files of runs that were interrupted (e.g. the daemon was killed).
+    A file that fails again is given up, so it can not keep every later run from importing its time window
+    """
+    for checkpoint in db.unfinished_checkpoints():
+        if os.path.exists(checkpoint.filename) and file_hash(checkpoint.filename) == checkpoint.filehash:
+            logger.info("Resuming interrupted import of %s", checkpoint.filename)
+            try:
+                _import_file(checkpoint.filename, dhis, db)
+            except Exception as e:
+                logger.exception("Could not resume import of %s - giving it up: %s", checkpoint.filename, e)
+                db.delete_checkpoint(checkpoint.filehash)
+        else:
+            logger.warning("Can not resume import of %s - file is gone or changed", checkpoint.filename)
+            db.delete_checkpoint(checkpoint.filehash)
+
+
+# number of records read ahead to look up their SIDs in the ledger and in DHIS2 at once
+READ_AHEAD = 500
+# number of records after which the progress of a file is stored in the local database
+CHECKPOINT_INTERVAL = 100
+
+# why a record is skipped - logged lazily with its SID
+ALREADY_IMPORTED = "Record for ID %s was already imported"
+BEING_IMPORTED = "Record for ID %s is already being imported"
+SUPERSEDED = "Record for ID %s is superseded by another record of the file"
+
+
+class Summary(object):
+    """Counters of a run - only updated by the main thread"""
+    def __init__(self, records=0, imported=0, duplicates=0, errors=0):
+        self.records = records
+        self.imported = imported
+        self.duplicates = duplicates
+        self.errors = errors
+
+
+class FileCheckpoint(object):
+    """Progress of a SmartVA file stored in the local database so an interrupted run can be resumed"""
+    def __init__(self, smartva_file, db, filehash=None):
+        self.smartva_file = smartva_file
+        self.db = db
+        self.filehash = filehash or file_hash(smartva_file)
+        checkpoint = db.get_checkpoint(self.filehash)
+        if checkpoint:
+            logger.info("Resuming %s after row %d", smartva_file, checkpoint.lastrow)
+            self.lastrow = checkpoint.lastrow
+            self.summary = Summary(checkpoint.records, checkpoint.imported, checkpoint.duplicates, checkpoint.errors)
+        else:
+            self.lastrow = 0
+            self.summary = Summary()
+            db.write_checkpoint(self.filehash, smartva_file, self.lastrow, self.summary)
+
+    def handled(self, job):
+        """Store a checkpoint every CHECKPOINT_INTERVAL records written to the local database"""
+        if job.index % CHECKPOINT_INTERVAL == 0:
+            # a checkpoint must not cover writes that are still queued
+            self.db.flush()
+            self.db.write_checkpoint(self.filehash, self.smartva_file, job.index, self.summary)
+
+    def finish(self):
+        # everything of the file is written before the summary is logged
+        self.db.flush()
+        self.db.delete_checkpoint(self.filehash)
+
+
+class Job(object):
+    """A record of the SmartVA file on its way to DHIS2"""
+    def __init__(self, index, record, progress):
+        self.index = index
+        self.record = record
+        # percentage of the SmartVA file read
+        self.progress = progress
+        self.sid = sanitize(record, Sid.csv_name)
+        # reason the record is skipped, a message to log with its SID
+        self.skipped = None
+        # DuplicateSidInFileError if another record of the file with the same SID is imported instead
+        self.superseded = None
+        # hash of the record's content, and whether its validation errors were taken from the local database
+        self.rowhash = None
+        self.cached = False
+        self.va = None
+        self.errors = []
+        self.warnings = []
+        self.event = None
+        # (event UID, exception) of the import
+        self.outcome = None
+        # future of the chunk of events the record is posted with and its position in there (asyncio)
+        self.future = None
+        self.position = None
+
+    def done(self):
+        return self.event is None or (self.future is not None and self.future.done())
+
+    def result(self):
+        """Return (event UID, exception) of the import"""
+        if self.outcome is None:
+            self.outcome = self.future.result()[self.position]
+        return self.outcome
+
+
+def _import(smartva_file, dhis, db):
+    """Validate every record of a SmartVA file and import it to DHIS2 in a pipeline of stages:
+    read (and look up the ledger) -> validate -> resolve duplicates -> post -> record.
+    Validation runs in `[pipeline] validate_workers` threads, the post stage hands the chunks of every window
+    to a pool of `[dhis] workers` threads, so up to that many requests are in flight within and across windows.
+    Logging and local database writes stay in the order of the file (the latter on the database writer thread).
+    """
+    checkpoint, winners = _scan(smartva_file, db)
+    summary = checkpoint.summary
+    imported = set()
+    in_flight = set()
+    # guards `imported` and `in_flight` shared by the resolve stage and the main thread
+    lock = threading.Lock()
+
+    def read():
+        for window in _read_ahead(smartva_file, checkpoint.lastrow):
+            with lock:
+                sids = _window_sids(window, imported, in_flight)
+            found = db.imported_sids(sids)
+            with lock:
+                # SIDs that we imported ourselves never need to be validated or reach DHIS2 again
+                imported.update(found)
+                jobs = [_job(index, record, progress, imported, winners) for index, record, progress in window]
+            _lookup_failures(db, jobs)
+            yield jobs
+
+    def resolve(jobs):
+        with lock:
+            for job in jobs:
+                _admit(job, imported, in_flight)
+        if not _skip_existing_check():
+            # one batched duplicate check for the window instead of one request per record
+            _resolve_existing(dhis, jobs)
+        return jobs
+
+    processes = None
+    validate = _validate
+    if PipelineConfig.validate_processes > 0:
+        processes = _validation_processes(PipelineConfig.validate_processes)
+        validate = partial(_validate_in_processes, processes)
+
+    posting = ThreadPoolExecutor(max_workers=max(DhisConfig.workers, 1))
+    pipeline = Pipeline([
+        Stage('validate', validate, workers=PipelineConfig.validate_workers),
+        Stage('resolve', resolve),
+        Stage('post', partial(_post_jobs, posting, dhis))
+    ], queue_size=PipelineConfig.queue_size)
+
+    try:
+        for jobs in pipeline.run(read()):
+            for job in jobs:
+                if job.future is not None:
+                    # wait for the POST outside of the lock, so the resolve stage can admit records meanwhile
+                    job.result()
+                with lock:
+                    _handle(job, db, summary, imported)
+                    in_flight.discard(job.sid)
+                checkpoint.handled(job)
+    finally:
+        posting.shutdown()
+        if processes:
+            processes.shutdown()
+
+    checkpoint.finish()
+    return summary
+
+
+def _job(index, record, progress, imported, winners):
+    """Create the job of a record - records of imported SIDs and records superseded by another record
+    of the file with the same SID are skipped without validation
+    """
+    job = Job(index, record, progress)
+    if job.sid in imported:
+        job.skipped = ALREADY_IMPORTED
+    elif winners.get(job.sid, index) != index:
+        job.skipped = SUPERSEDED
+        job.superseded = DuplicateSidInFileError("row {}".format(winners[job.sid]))
+    return job
+
+
+def _scan(smartva_file, db):
+    """The first of the two passes over a SmartVA file, before the import: index its duplicate SIDs and hash it.
+    Returns its FileCheckpoint and the winners of `_duplicate_sid_winners`
+    """
+    digest = hashlib.sha256()
+    winners = _duplicate_sid_winners(smartva_file, digest)
+    return FileCheckpoint(smartva_file, db, digest.hexdigest()), winners
+
+
+def _duplicate_sid_winners(smartva_file, digest=None):
+    """Read the SIDs of a SmartVA file before any request is made and return {SID: index of the record to import}
+    of the SIDs in more than one record, chosen by `[pipeline] duplicate_sid_winner`.
+    digest: a hashlib object updated with the bytes of the file (see `read_csv`)
+    """
+    by_interview_date = PipelineConfig.duplicate_sid_winner == 'latest_interview_date'
+    winners = {}
+    duplicates = set()
+    for index, record in enumerate(read_csv(smartva_file, mapped_only=True, digest=digest), 1):
+        sid = sanitize(record, Sid.csv_name)
+        if not sid:
+            continue
+        if by_interview_date:
+            interview_date = sanitize(record, InterviewDate.csv_name)
+            # unparseable dates lose against any date, the last row wins on ties
+            key = ((interview_date and (iso_date(interview_date) or odk_date(interview_date))) or '', index)
+        else:
+            key = index
+        if sid in winners:
+            duplicates.add(sid)
+            if key < winners[sid]:
+                continue
+        winners[sid] = key
+    if by_interview_date:
+        return {sid: winners[sid][1] for sid in duplicates}
+    return {sid: winners[sid] for sid in duplicates}
+
+
+def _lookup_failures(db, jobs):
+    """Take the validation errors of records whose unchanged content failed validation in an earlier run
+    from the local database instead of validating them again
+    """
+    to_validate = [job for job in jobs if not job.skipped]
+    for job in to_validate:
+        job.rowhash = validation_hash(job.record)
+    failures = db.validation_failures([job.rowhash for job in to_validate])
+    for job in to_validate:
+        if job.rowhash in failures:
+            error_codes, warning_codes = failures[job.rowhash]
+            job.errors = [validation_exceptions[c]() for c in error_codes]
+            job.warnings = [validation_exceptions[c]() for c in warning_codes]
+            job.cached = True
+
+
+def _validate(jobs):
+    """Validate records and create their events - runs in a validation thread"""
+    for job in jobs:
+        _validate_job(job)
+    return jobs
+
+
+def _validate_job(job):
+    """Validate a record and create its event unless it is skipped or its validation failures are cached"""
+    if not job.skipped and not job.cached:
+        job.va, job.errors, job.warnings = verbal_autopsy_factory(job.record)
+        if not job.errors:
+            job.event = Event(job.va)
+
+
+def _validation_processes(workers):
+    """Pool of validation processes that are not forked from this process: it runs other threads
+    (pipeline stages, database writer, log file) and forking a process with threads can deadlock"""
+    if sys.version_info >= (3, 7):
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    # before Python 3.7 the pool always forks - start all workers before the pipeline starts its threads
+    processes = ProcessPoolExecutor(max_workers=workers)
+    processes.submit(int).result()
+    return processes
+
+
+def _validate_in_processes(processes, jobs):
+    """Validate records split across the worker processes, which only send back attributes and codes"""
+    to_validate = [job for job in jobs if not job.skipped and not job.cached]
+    size = max(1, -(-len(to_validate) // PipelineConfig.validate_processes))
+    futures = [processes.submit(validate_compact, [job.record for job in to_validate[i:i + size]])
+               for i in range(0, len(to_validate), size)]
+    results = [compact for future in futures for compact in future.result()]
+    for job, compact in zip(to_validate, results):
+        job.va, job.errors, job.warnings = verbal_autopsy_from_compact(*compact)
+        if not job.errors:
+            job.event = Event(job.va)
+    return jobs
+
+
+def _admit(job, imported, in_flight):
+    """Skip a record whose SID got imported or is being imported by an earlier record of the file"""
+    if job.skipped:
+        return
+    if job.sid in imported:
+        job.skipped = ALREADY_IMPORTED
+    elif job.sid in in_flight:
+        job.skipped = BEING_IMPORTED
+    elif job.event is not None:
+        in_flight.add(job.sid)
+    if job.skipped:
+        job.event = None
+
+
+def _resolve_existing(dhis, jobs):
+    """Check DHIS2 for existing events of the records to post and mark those as duplicates"""
+    to_post = [job for job in jobs if job.event is not None]
+    existing = dhis.existing_events([job.sid for job in to_post])
+    for job in to_post:
+        try:
+            raise_if_existing(existing, job.sid)
+        except DuplicateEventImportError as e:
+            job.outcome = (None, e)
+
+
+def _post_jobs(posting, dhis, jobs):
+    """Submit the events of a window in chunks of `[dhis] bulk_chunk_size` (or single records) to the pool
+    of posting threads - the main thread waits for the results of the records (see `Job.result`)"""
+    to_post = [job for job in jobs if job.event is not None and job.outcome is None]
+    # without the batched check, `_post_chunk` checks every record on its own
+    existing = None if _skip_existing_check() else {}
+    chunk_size = max(DhisConfig.bulk_chunk_size, 1)
+    for i in range(0, len(to_post), chunk_size):
+        chunk = to_post[i:i + chunk_size]
+        future = posting.submit(_post_chunk, dhis, [job.event for job in chunk], existing)
+        for position, job in enumerate(chunk):
+            job.future, job.position = future, position
+    return jobs
+
+
+def _skip_existing_check():
+    """Whether to skip the batched duplicate check"""
+    return DhisConfig.skip_duplicate_check or DhisConfig.duplicate_check_chunk_size <= 0
+
+
+def _read_ahead(smartva_file, lastrow=0):
+    """Read the SmartVA file in a single pass and yield lists of (index, record, progress) of READ_AHEAD records.
+    Rows up to `lastrow` were already processed by an interrupted run and are skipped.
+    """
+    window = []
+    for index, (record, progress) in enumerate(read_csv(smartva_file, with_progress=True, mapped_only=True), 1):
+        if index <= lastrow:
+            continue
+        window.append((index, record, progress))
+        if len(window) >= READ_AHEAD:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _window_sids(window, imported, in_flight):
+    """SIDs of a read-ahead window that still need to be looked up"""
+    sids = {sanitize(record, Sid.csv_name) for _, record, _ in window}
+    return [sid for sid in sids if sid and sid not in imported and sid not in in_flight]
+
+
+def _prepare(job, imported, in_flight):
+    """The validate and resolve stages of `_import` for a single record (asyncio)"""
+    _validate_job(job)
+    _admit(job, imported, in_flight)
+    return job
+
+
+def _run_async(coroutine):
+    """Run a coroutine on a new event loop"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def _import_async(smartva_file, dhis, db):
+    """asyncio variant of `_import`: duplicate checks and POSTs of up to `[dhis] async_concurrency` records
+    are in flight at the same time on a single thread. Results are handled in the order of the file.
+    """
+    checkpoint, winners = _scan(smartva_file, db)
+    summary = checkpoint.summary
+    imported = set()
+    existing = None if _skip_existing_check() else {}
+
+    async with AsyncDhis(root_orgunit=dhis.root_orgunit) as adhis:
+        chunk_size = max(DhisConfig.bulk_chunk_size, 1)
+        max_queued = 2 * DhisConfig.async_concurrency * chunk_size
+        queue = deque()
+        chunk = []
+        in_flight = set()
+
+        def submit():
+            future = asyncio.ensure_future(_post_chunk_async(adhis, [job.event for job in chunk], existing))
+            for position, job in enumerate(chunk):
+                job.future, job.position = future, position
+            del chunk[:]
+
+        async def handle_head():
+            if queue[0].future is None and queue[0].event is not None:
+                submit()
+            if not queue[0].done():
+                await asyncio.wait([queue[0].future])
+            job = queue.popleft()
+            _handle(job, db, summary, imported)
+            in_flight.discard(job.sid)
+            checkpoint.handled(job)
+
+        for window in _read_ahead(smartva_file, checkpoint.lastrow):
+            sids = _window_sids(window, imported, in_flight)
+            imported.update(db.imported_sids(sids))
+            if existing is not None:
+                existing.update(await adhis.existing_events([sid for sid in sids if sid not in imported]))
+
+            jobs = [_job(index, record, progress, imported, winners) for index, record, progress in window]
+            _lookup_failures(db, jobs)
+            for job in jobs:
+                _prepare(job, imported, in_flight)
+                if job.event is not None:
+                    chunk.append(job)
+                    if len(chunk) >= chunk_size:
+                        submit()
+                queue.append(job)
+
+                while queue and (len(queue) > max_queued or queue[0].done()):
+                    await handle_head()
+                # let the requests in flight progress while reading the file
+                await asyncio.sleep(0)
+
+        if chunk:
+            submit()
+        while queue:
+            await handle_head()
+
+    checkpoint.finish()
+    return summary
+
+
+async def _post_chunk_async(dhis, events, existing):
+    """asyncio variant of `_post_chunk`, all requests of a chunk run concurrently"""
+    results, to_check = _check_existing(events, existing)
+
+    async def check(position):
+        try:
+            await dhis.is_duplicate(events[position].sid)
+        except DuplicateEventImportError as e:
+            results[position] = (None, e)
+
+    await asyncio.gather(*[check(position) for position in to_check])
+    to_post = _to_post(results)
+
+    if DhisConfig.bulk_chunk_size > 1:
+        if to_post:
+            _set_bulk_results(results, to_post, await dhis.post_events([events[position] for position in to_post]))
+    else:
+        async def post(position):
+            try:
+                results[position] = (await dhis.post_event(events[position]), None)
+            except ImportException as e:
+                results[position] = (None, e)
+
+        await asyncio.gather(*[post(position) for position in to_post])
+    return results
+
+
+def _post_chunk(dhis, events, existing):
+    """Check a chunk of events for duplicates and POST it - runs in a worker thread.
+    Returns a list of (event UID, exception) tuples in the order of the events
+    """
+    results, to_check = _check_existing(events, existing)
+    for position in to_check:
+        try:
+            dhis.is_duplicate(events[position].sid)
+        except DuplicateEventImportError as e:
+            results[position] = (None, e)
+    to_post = _to_post(results)
+
+    if DhisConfig.bulk_chunk_size > 1:
+        if to_post:
+            _set_bulk_results(results, to_post, dhis.post_events([events[position] for position in to_post]))
+    else:
+        for position in to_post:
+            try:
+                results[position] = (dhis.post_event(events[position]), None)
+            except ImportException as e:
+                results[position] = (None, e)
+    return results
+
+
+def _check_existing(events, existing):
+    """Duplicate check of a chunk that needs no request: against `existing` of the batched check, or none
+    if duplicate checks are skipped. Returns the results with (None, exception) for the events that exist already
+    and None for the others, and the positions of the events to check with a request per SID
+    """
+    results = [None] * len(events)
+    to_check = []
+    for position, event in enumerate(events):
+        if existing is not None:
+            try:
+                raise_if_existing(existing, event.sid)
+            except DuplicateEventImportError as e:
+                results[position] = (None, e)
+        elif not DhisConfig.skip_duplicate_check:
+            to_check.append(position)
+    return results, to_check
+
+
+def _to_post(results):
+    """Positions of the events of a chunk that were not found in DHIS2"""
+    return [position for position, result in enumerate(results) if result is None]
+
+
+def _set_bulk_results(results, to_post, bulk_results):
+    """Set the results of the events posted in one bulk import"""
+    for position, (_, event_uid, exc) in zip(to_post, bulk_results):
+        results[position] = (event_uid, exc)
+
+
+def _handle(job, db, summary, imported):
+    """Log the outcome of a record and queue it for the local database - runs in the main thread"""
+    summary.records += 1
+    logger.info("[%d | %.0f%%] SID: %s", job.index, job.progress, job.record.get('sid'))
+    if job.skipped:
+        logger.info(job.skipped, job.sid)
+        if job.superseded:
+            logger.info("%s", job.superseded)
+            db.record_errors(job.record, job.superseded)
+        summary.duplicates += 1
+        return
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Parsed from CSV: %s", job.record)
+        logger.debug("VA data: %s", job.va)
+
+    for w in job.warnings:
+        logger.warning(w)
+
+    if job.errors:
+        for e in job.errors:
+            logger.error(e)
+        if job.cached:
+            logger.info("Validation errors of record for ID %s were recorded already", job.sid)
+        else:
+            db.record_errors(job.record, job.errors)
+            db.record_validation_failure(job.rowhash, job.sid, job.errors, job.warnings)
+        summary.errors += 1
+        return
+
+    event_uid, exc = job.result()
+    if isinstance(exc, DuplicateEventImportError):
+        logger.warning("Record for ID %s already exists in DHIS2", job.record.get('sid'))
+        db.record_errors(job.record, exc)
+        summary.duplicates += 1
+    elif exc:
+        logger.error("%s\nfor payload %s", exc, job.event)
+        db.record_errors(job.record, exc)
+        summary.errors += 1
+    else:
+        logger.info("Import successful!")
+        db.record_imported(job.va.sid, event_uid)
+        imported.add(job.va.sid)
+        summary.imported += 1
+
+
 def launch():
     try:
         opts = _parse_args()
@@ -0,0 +1,184 @@
+import asyncio
+import csv
+import json
+import os
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from smartvadhis2.core.aiodhis import AsyncDhis
+from smartvadhis2.core.config import Config, DhisConfig, ODKConfig
+from smartvadhis2.core.database import Database
+from smartvadhis2.core.exceptions.errors import DuplicateEventImportError
+from smartvadhis2.core.mapping import Sid
+from smartvadhis2.run import _import_async, _run_async
+
+EXISTING = {'VA_12345678912345': 'zLPwmHJVr09'}
+
+
+class StubDhis(BaseHTTPRequestHandler):
+    """Minimal DHIS2 API answering like a 2.28 server"""
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def log_message(self, *_):
+        pass
+
+    def respond(self, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/api/28/system/info.json':
+            self.respond({'version': '2.28'})
+        elif url.path == '/api/28/organisationUnits.json':
+            self.respond({'organisationUnits': [{'id': 'ImspTQPwCqd'}]})
+        elif url.path == '/api/28/events/query.json':
+            sids = params['filter'][0].split(':', 2)[2].split(';')
+            rows = [[EXISTING[sid], sid] for sid in sids if sid in EXISTING]
+            self.respond({'headers': [{'name': 'event'}, {'name': Sid.dhis_uid}], 'rows': rows, 'height': len(rows)})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with StubDhis.lock:
+            StubDhis.in_flight += 1
+            StubDhis.max_in_flight = max(StubDhis.max_in_flight, StubDhis.in_flight)
+        # simulate a high-latency link
+        time.sleep(0.05)
+        with StubDhis.lock:
+            StubDhis.in_flight -= 1
+        events = payload.get('events', [payload])
+        self.respond({
+            'httpStatusCode': 200,
+            'response': {
+                'imported': len(events),
+                'updated': 0,
+                'ignored': 0,
+                'deleted': 0,
+                'importSummaries': [
+                    {'status': 'SUCCESS', 'importCount': {'imported': 1, 'updated': 0}, 'reference': e['event']}
+                    for e in events
+                ]
+            }
+        })
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture(scope='module')
+def stub_server():
+    server = ThreadingServer(('127.0.0.1', 0), StubDhis)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def baseurl(stub_server, monkeypatch):
+    monkeypatch.setattr(DhisConfig, 'baseurl', '127.0.0.1:{}'.format(stub_server.server_address[1]))
+    monkeypatch.setattr(DhisConfig, 'skip_duplicate_check', False)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_connect(baseurl):
+    async def connect():
+        async with AsyncDhis() as dhis:
+            return dhis.root_orgunit, dhis.dhis_version
+
+    assert run(connect()) == ('ImspTQPwCqd', '2.28')
+
+
+def test_is_duplicate(baseurl):
+    async def check(sid):
+        async with AsyncDhis() as dhis:
+            await dhis.is_duplicate(sid)
+
+    with pytest.raises(DuplicateEventImportError):
+        run(check('VA_12345678912345'))
+    run(check('VA_00000000000000'))
+
+
+def test_existing_events(baseurl):
+    async def existing():
+        async with AsyncDhis() as dhis:
+            return await dhis.existing_events(['VA_00000000000000', 'VA_12345678912345'], chunk_size=1)
+
+    assert run(existing()) == {'VA_12345678912345': ['zLPwmHJVr09']}
+
+
+def test_post_event_concurrency_limit(baseurl):
+    StubDhis.max_in_flight = 0
+
+    async def post_all():
+        async with AsyncDhis(concurrency=5) as dhis:
+            return await asyncio.gather(*[dhis.post_event({'event': 'uid{:08d}'.format(i)}) for i in range(20)])
+
+    start = time.time()
+    uids = run(post_all())
+    assert uids == ['uid{:08d}'.format(i) for i in range(20)]
+    assert StubDhis.max_in_flight <= 5
+    # 20 requests with 5 in flight take about 4 round trips, not 20
+    assert time.time() - start < 20 * 0.05
+
+
+class Root(object):
+    root_orgunit = 'ImspTQPwCqd'
+
+
+def smartva_file(tmp_path, sids):
+    """A SmartVA file of valid records with `sids` and a record that fails validation"""
+    template = list(csv.DictReader(open(os.path.join(Config.ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv'))))
+    path = str(tmp_path / 'smartva.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(template[0].keys()))
+        writer.writeheader()
+        for i, sid in enumerate(sids):
+            row = dict(template[i % 3])
+            row.update(sid=sid, age=['48', '82', '0.02'][i % 3], birth_date='1970-01-01')
+            writer.writerow(row)
+        writer.writerow(dict(template[0], sid='VA_99999999999999', sex='7'))
+    return path
+
+
+@pytest.mark.parametrize('bulk_chunk_size', [0, 5])
+def test_import_async(baseurl, monkeypatch, tmp_path, bulk_chunk_size):
+    monkeypatch.setattr(DhisConfig, 'bulk_chunk_size', bulk_chunk_size)
+    monkeypatch.setattr(ODKConfig, 'sid_regex', r'^VA_[0-9]{14}$')
+    sids = ['VA_{:014d}'.format(i) for i in range(11)] + ['VA_12345678912345']
+    path = smartva_file(tmp_path, sids)
+    db = Database('sqlite:///' + str(tmp_path / 'local.db'))
+    try:
+        summary = _run_async(_import_async(path, Root(), db))
+        assert (summary.records, summary.imported, summary.duplicates, summary.errors) == (13, 11, 1, 1)
+
+        # imported SIDs are skipped from the local database and failures are cached
+        summary = _run_async(_import_async(path, Root(), db))
+        assert (summary.records, summary.imported, summary.duplicates, summary.errors) == (13, 0, 12, 1)
+    finally:
+        db.close()
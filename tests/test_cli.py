@@ -631,6 +631,7 @@ def test_print_error_categories(capsys):
                "- ID:703 - Non-categorized import exception\n" \
                "- ID:704 - Event for VA.SID already exists\n" \
                "- ID:705 - Orgunit is not assigned to program\n" \
+               "- ID:706 - Record for VA.SID superseded by another record of the same file\n" \
                "Validation Warnings (800-899)\n" \
                "- ID:800 - [age] missing\n" \
                "- ID:801 - [birth_date] missing\n" \
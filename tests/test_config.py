@@ -2,6 +2,7 @@ import os
 import logging
 
 import pytest
+from logzero import logger
 
 from smartvadhis2.core.config import (
     DataDirConfig,
@@ -93,5 +94,19 @@ def test_logging_config():
     assert cfg.log_level in {logging.INFO, logging.WARNING, logging.DEBUG}
 
 
+def test_logging_async_logfile(tmpdir, monkeypatch):
+    log_file = str(tmpdir.join('smartva_dhis2.log'))
+    monkeypatch.setattr(LoggingConfig, 'log_file', log_file)
+    monkeypatch.setattr(LoggingConfig, 'async_logfile', True)
+    LoggingConfig().setup()
+    try:
+        logger.info("written by %s", 'the listener')
+    finally:
+        # writes the queued records
+        LoggingConfig.stop_logfile()
+    with open(log_file) as f:
+        assert "written by the listener" in f.read()
+
+
 def test_python_version():
     check_python_version()
@@ -1,10 +1,16 @@
 import os
+import sqlite3
+import threading
+import time
 
 import pytest
 from sqlalchemy.orm import Session
 
 from smartvadhis2.core.config import DatabaseConfig, Config
+from smartvadhis2.core.database import configure_db, get_db
 from smartvadhis2.core.exceptions import db_exceptions
+from smartvadhis2.core.exceptions.errors import DuplicateSidInFileError, SexParseError
+from smartvadhis2.core.helpers import read_csv
 from smartvadhis2.core.models import *
 
 db_url = os.path.join(Config.ROOT_DIR, 'tests', DatabaseConfig.db_name.replace('.db', '') + '_test.db')
@@ -21,6 +27,9 @@ def tables(engine):
     Person.__table__.create(bind=engine, checkfirst=True)
     Failure.__table__.create(bind=engine, checkfirst=True)
     PersonFailure.__table__.create(bind=engine, checkfirst=True)
+    ImportedEvent.__table__.create(bind=engine, checkfirst=True)
+    Checkpoint.__table__.create(bind=engine, checkfirst=True)
+    ValidationFailure.__table__.create(bind=engine, checkfirst=True)
     yield
 
 
@@ -91,4 +100,98 @@ def test_add_failure_categories(dbsession):
     dbsession.add_all(f)
     dbsession.commit()
 
-    assert dbsession.query(Failure.failureid).count() == len(db_exceptions)
\ No newline at end of file
+    assert dbsession.query(Failure.failureid).count() == len(db_exceptions)
+
+
+def test_add_imported_event(dbsession):
+    imported = ImportedEvent(sid='VA_12345678912345', event='zLPwmHJVr09')
+    dbsession.add(imported)
+    dbsession.commit()
+
+    assert dbsession.query(ImportedEvent).filter(ImportedEvent.sid == 'VA_12345678912345').one().event == 'zLPwmHJVr09'
+    assert isinstance(imported.created, datetime)
+
+
+def test_add_checkpoint(dbsession):
+    checkpoint = Checkpoint(filehash='a' * 64, filename='smartva.csv', lastrow=100,
+                            records=100, imported=90, duplicates=5, errors=5)
+    dbsession.add(checkpoint)
+    dbsession.commit()
+
+    queried = dbsession.query(Checkpoint).filter(Checkpoint.filehash == 'a' * 64).one()
+    assert queried.lastrow == 100
+    assert queried.imported + queried.duplicates + queried.errors == queried.records
+    assert isinstance(queried.created, datetime)
+
+
+def test_add_validation_failure(dbsession):
+    failure = ValidationFailure(rowhash='b' * 64, sid='VA_12345678912345', errors='601,609', warnings='')
+    dbsession.add(failure)
+    dbsession.commit()
+
+    queried = dbsession.query(ValidationFailure).filter(ValidationFailure.rowhash == 'b' * 64).one()
+    assert queried.errors.split(',') == ['601', '609']
+    assert isinstance(queried.created, datetime)
+
+
+@pytest.fixture
+def local_db(tmp_path):
+    db_file = str(tmp_path / 'local.db')
+    configure_db('sqlite:///' + db_file)
+    yield db_file
+    configure_db()
+
+
+def test_get_db_lazy(local_db):
+    assert not os.path.exists(local_db)
+    databases = []
+    threads = [threading.Thread(target=lambda: databases.append(get_db())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.path.exists(local_db)
+    assert all(db is get_db() for db in databases)
+
+
+def test_record_errors_flush(local_db):
+    db = get_db()
+    record = next(iter(read_csv(os.path.join(Config.ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv'))))
+    db.record_errors(record, SexParseError())
+    db.record_errors(record, [SexParseError(), DuplicateSidInFileError('row 2')])
+    db.write_errors(record, SexParseError())
+    db.flush()
+
+    session = db.Session()
+    try:
+        assert session.query(Person).filter(Person.sid == record['sid']).count() == 1
+        assert sorted(row.failureid for row in session.query(PersonFailure)) == [607, 706]
+    finally:
+        session.close()
+
+
+def test_record_imported_flush(local_db):
+    db = get_db()
+    sids = ['VA_{:017d}'.format(i) for i in range(250)]
+    for sid in sids:
+        db.record_imported(sid, 'zLPwmHJVr09')
+    db.flush()
+    assert db.imported_sids(sids) == set(sids)
+
+
+def test_writer_does_not_block_producers(local_db):
+    db = get_db()
+    record = next(iter(read_csv(os.path.join(Config.ROOT_DIR, 'tests', 'testdata', 'smartva_test.csv'))))
+    # another process holds the write lock of the database for a while
+    other = sqlite3.connect(local_db, check_same_thread=False)
+    other.execute('BEGIN IMMEDIATE')
+    threading.Timer(0.5, other.rollback).start()
+
+    start = time.perf_counter()
+    db.record_errors(record, SexParseError())
+    db.record_imported('VA_12345678912345', 'zLPwmHJVr09')
+    assert time.perf_counter() - start < 0.5
+
+    db.flush()
+    assert db.imported_sids(['VA_12345678912345']) == {'VA_12345678912345'}
+    other.close()
@@ -1,6 +1,6 @@
 import pytest
 
-from smartvadhis2.core.dhis import RaiseImportFailure, raise_if_duplicate, Dhis
+from smartvadhis2.core.dhis import RaiseImportFailure, raise_if_duplicate, raise_if_existing, parse_existing_events, Dhis
 from smartvadhis2.core.exceptions.errors import *
 from smartvadhis2.core.exceptions.base import DhisApiException
 
@@ -215,6 +215,7 @@ def test_import_success():
         }
     }
     import_status = RaiseImportFailure(response)
+    assert import_status.references == ["IgEemKlf33z", "onXW2DQHRGS", "A7vnB73x5Xw"]
     assert import_status.status_code == 200
     assert import_status.imported == 2
     assert import_status.deleted == 0
@@ -745,3 +746,160 @@ def test_get_root_orgunit_none():
     }
     with pytest.raises(DhisApiException):
         Dhis._get_root_id(response)
+
+
+def test_bulk_import_per_event():
+    sids = ['VA_1', 'VA_2', 'VA_3']
+    response = {
+        "httpStatus": "Conflict",
+        "httpStatusCode": 409,
+        "status": "ERROR",
+        "message": "An error occurred, please check import summary.",
+        "response": {
+            "responseType": "ImportSummaries",
+            "status": "ERROR",
+            "imported": 1,
+            "updated": 0,
+            "deleted": 0,
+            "ignored": 2,
+            "importSummaries": [
+                {
+                    "responseType": "ImportSummary",
+                    "status": "SUCCESS",
+                    "importCount": {"imported": 1, "updated": 0, "ignored": 0, "deleted": 0},
+                    "reference": "IgEemKlf33z"
+                },
+                {
+                    "responseType": "ImportSummary",
+                    "status": "ERROR",
+                    "description": "Event.orgUnit does not point to a valid organisation unit: tbd",
+                    "importCount": {"imported": 0, "updated": 0, "ignored": 1, "deleted": 0}
+                },
+                {
+                    "responseType": "ImportSummary",
+                    "status": "WARNING",
+                    "conflicts": [
+                        {
+                            "object": "dataElement",
+                            "value": "sWoqcoByYmE is not a valid data element"
+                        }
+                    ],
+                    "importCount": {"imported": 0, "updated": 0, "ignored": 1, "deleted": 0}
+                }
+            ]
+        }
+    }
+    results = RaiseImportFailure.per_event(response, sids)
+    assert [sid for sid, _, _ in results] == sids
+    assert results[0][1] == "IgEemKlf33z"
+    assert results[0][2] is None
+    assert isinstance(results[1][2], OrgunitNotValidImportError)
+    assert isinstance(results[2][2], GenericImportError)
+
+
+def test_bulk_import_per_event_warning_imported():
+    response = {
+        "httpStatusCode": 200,
+        "response": {
+            "status": "WARNING",
+            "imported": 1,
+            "updated": 0,
+            "deleted": 0,
+            "ignored": 0,
+            "importSummaries": [
+                {
+                    "responseType": "ImportSummary",
+                    "status": "WARNING",
+                    "conflicts": [{"object": "sWoqcoByYmE", "value": "value_not_numeric"}],
+                    "importCount": {"imported": 1, "updated": 0, "ignored": 0, "deleted": 0},
+                    "reference": "IgEemKlf33z"
+                }
+            ]
+        }
+    }
+    # same outcome as for a single event
+    assert RaiseImportFailure(response).imported == 1
+    assert RaiseImportFailure.per_event(response, ['VA_1']) == [('VA_1', 'IgEemKlf33z', None)]
+
+
+def test_bulk_import_per_event_by_reference():
+    response = {
+        "response": {
+            "importSummaries": [
+                {"status": "SUCCESS", "importCount": {"imported": 1}, "reference": "yPzV1Rzkb3n"},
+                {"status": "SUCCESS", "importCount": {"imported": 1}, "reference": "IgEemKlf33z"}
+            ]
+        }
+    }
+    results = RaiseImportFailure.per_event(response, ['VA_1', 'VA_2', 'VA_3'],
+                                           ['IgEemKlf33z', 'Rq2s3wsxQFa', 'yPzV1Rzkb3n'])
+    assert [(sid, uid) for sid, uid, _ in results] == [('VA_1', 'IgEemKlf33z'), ('VA_2', None), ('VA_3', 'yPzV1Rzkb3n')]
+    assert results[0][2] is None and results[2][2] is None
+    assert isinstance(results[1][2], GenericImportError)
+
+
+def test_bulk_import_per_event_unparseable():
+    sids = ['VA_1', 'VA_2']
+    results = RaiseImportFailure.per_event({"Unknown response"}, sids)
+    assert [sid for sid, _, _ in results] == sids
+    assert all(isinstance(exc, GenericImportError) for _, _, exc in results)
+
+
+def test_existing_events_parsed():
+    response = {
+        "headers": [
+            {"name": "event", "column": "event", "type": "java.lang.String", "hidden": False, "meta": False},
+            {"name": "orgUnit", "column": "orgUnit", "type": "java.lang.String", "hidden": False, "meta": False},
+            {"name": "L370gG5pb3P", "column": "SID", "type": "java.lang.String", "hidden": False, "meta": False}
+        ],
+        "rows": [
+            ["zLPwmHJVr09", "MJ0S8In5PIQ", "VA_12345678912345"],
+            ["onXW2DQHRGS", "MJ0S8In5PIQ", "VA_12345678912345"],
+            ["A7vnB73x5Xw", "wrGMB1SnYGR", "VA_98765432198765"]
+        ],
+        "width": 3,
+        "height": 3
+    }
+    existing = parse_existing_events(response)
+    assert existing == {
+        "VA_12345678912345": ["zLPwmHJVr09", "onXW2DQHRGS"],
+        "VA_98765432198765": ["A7vnB73x5Xw"]
+    }
+    with pytest.raises(DuplicateEventImportError):
+        raise_if_existing(existing, "VA_12345678912345")
+    raise_if_existing(existing, "VA_00000000000000")
+
+
+def test_existing_events_none_found():
+    response = {"headers": [], "rows": [], "width": 0, "height": 0}
+    assert parse_existing_events(response) == {}
+
+
+def test_import_updated_existing_event():
+    response = {
+        "httpStatus": "OK",
+        "httpStatusCode": 200,
+        "status": "OK",
+        "message": "Import was successful.",
+        "response": {
+            "responseType": "ImportSummaries",
+            "status": "SUCCESS",
+            "imported": 0,
+            "updated": 1,
+            "deleted": 0,
+            "ignored": 0,
+            "importSummaries": [
+                {
+                    "responseType": "ImportSummary",
+                    "status": "SUCCESS",
+                    "importCount": {"imported": 0, "updated": 1, "ignored": 0, "deleted": 0},
+                    "reference": "IgEemKlf33z"
+                }
+            ]
+        }
+    }
+    with pytest.raises(DuplicateEventImportError):
+        RaiseImportFailure(response)
+
+    results = RaiseImportFailure.per_event(response, ['VA_1'])
+    assert isinstance(results[0][2], DuplicateEventImportError)
@@ -1,5 +1,7 @@
 import datetime
+import hashlib
 import os
+import pickle
 
 import pytest
 
@@ -9,10 +11,18 @@ from smartvadhis2.core.helpers import (
     get_timewindow,
     csv_with_content,
     years_to_days,
-    read_csv
+    read_csv,
+    read_columns,
+    MappedRow,
+    deterministic_uid,
+    file_hash,
+    iso_date,
+    odk_date
 )
 
 from smartvadhis2.core.config import Config
+from smartvadhis2.core.exceptions import FileException
+from smartvadhis2.core.mapping import MAPPING_PLAN
 
 
 def test_sanitize():
@@ -175,3 +185,100 @@ def test_read_csv():
     for i, row in enumerate(read_csv(data)):
         for key in row.keys():
             assert row.get(key, None) == expected[i][key]
+
+
+def test_deterministic_uid():
+    uid = deterministic_uid('HPrJOsYuM1K', 'VA_12345678912345')
+    assert is_uid(uid)
+    assert uid == deterministic_uid('HPrJOsYuM1K', 'VA_12345678912345')
+    assert uid != deterministic_uid('HPrJOsYuM1K', 'VA_12345678912346')
+    assert uid != deterministic_uid('Wv7sMthkvsy', 'VA_12345678912345')
+
+
+def test_read_csv_with_progress():
+    data = file_testdata('smartva_test.csv')
+    progress = [p for _, p in read_csv(data, with_progress=True)]
+    assert len(progress) == 3
+    assert progress == sorted(progress)
+    assert progress[-1] == 100.0
+
+
+def test_read_csv_mapped_only(tmpdir):
+    data = file_testdata('smartva_test.csv')
+    for row, mapped in zip(read_csv(data), read_csv(data, mapped_only=True)):
+        assert isinstance(mapped, MappedRow)
+        assert dict(mapped) == {k: v for k, v in row.items() if k in MAPPING_PLAN.csv_names}
+        assert mapped['sid'] == row['sid']
+        assert mapped.get('cause34') is None
+        assert pickle.loads(pickle.dumps(mapped)) == mapped
+
+    # columns missing from the file are not set, as with csv.DictReader
+    missing = tmpdir.join('missing.csv')
+    missing.write('sid,age\nVA_12345678912345678,48\n')
+    mapped = next(read_csv(str(missing), mapped_only=True))
+    assert mapped.get('sex', '') == ''
+    assert 'sex' not in mapped
+    with pytest.raises(KeyError):
+        mapped['sex']
+
+
+def test_read_csv_mapped_only_short_row(tmpdir):
+    # columns missing from a short row are None, as with csv.DictReader
+    short = tmpdir.join('short.csv')
+    short.write('sid,sex,death_date,interview_date\nVA_12345678912345678,x\n')
+    row = next(read_csv(str(short)))
+    mapped = next(read_csv(str(short), mapped_only=True))
+    assert dict(mapped) == row == {'sid': 'VA_12345678912345678', 'sex': 'x',
+                                   'death_date': None, 'interview_date': None}
+    assert mapped['interview_date'] is None
+    assert 'interview_date' in mapped
+    assert pickle.loads(pickle.dumps(mapped)) == mapped
+    with pytest.raises(KeyError):
+        mapped['age']
+
+
+def test_read_csv_digest():
+    data = file_testdata('smartva_test.csv')
+    digest = hashlib.sha256()
+    list(read_csv(data, mapped_only=True, digest=digest))
+    assert digest.hexdigest() == file_hash(data)
+
+
+def test_read_csv_unknown_column(tmpdir):
+    unknown = tmpdir.join('unknown.csv')
+    unknown.write('sid,unknown\nVA_12345678912345678,x\n')
+    for mapped_only in (False, True):
+        with pytest.raises(FileException):
+            list(read_csv(str(unknown), mapped_only=mapped_only))
+
+
+def test_read_columns():
+    columns = read_columns(file_testdata('smartva_test.csv'), names=['sid', 'interview_date'])
+    assert len(columns['sid']) == 3
+    assert len(columns['sid'].values) == 3
+    # the same date is only stored once
+    assert columns['interview_date'].values == ['Mar 26, 2018']
+    assert [columns['interview_date'][row] for row in range(3)] == ['Mar 26, 2018'] * 3
+
+
+def strptime_date(value, fmt):
+    try:
+        return datetime.datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+@pytest.mark.parametrize('value', [
+    '2018-01-01', '2016-02-29', '2018-02-29', '2018-13-01', '2018-00-10', '2018-01-32',
+    '2018-1-5', '0999-01-01', '20180101', '2018-01-01 ', 'Mar 26, 2018'
+])
+def test_iso_date(value):
+    assert iso_date(value) == strptime_date(value, '%Y-%m-%d')
+
+
+@pytest.mark.parametrize('value', [
+    'Mar 26, 2018', 'mar 26, 2018', 'Mar 5, 2018', 'Mar 05, 2018', 'Mar  26, 2018', 'Feb 29, 2016', 'Feb 29, 2018',
+    'Mar 32, 2018', 'March 26, 2018', 'Xyz 26, 2018', 'Mar 26,2018', 'Mar 26, 18', '2018-03-26'
+])
+def test_odk_date(value):
+    assert odk_date(value) == strptime_date(value, '%b %d, %Y')
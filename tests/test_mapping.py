@@ -10,6 +10,7 @@ from smartvadhis2.core.mapping import (
     Sex,
     AgeCategory,
     Icd10,
+    MAPPING_PLAN,
     cause_of_death_option_code
 )
 
@@ -35,6 +36,18 @@ def test_set_order():
     assert set(numbers) == {0, 1, 2}
 
 
+def test_mapping_plan():
+    csv_properties = [m for m in Mapping.properties() if m.csv_name is not None]
+    assert [code_name for _, code_name in MAPPING_PLAN.row_fields] == [
+        m.code_name for i in sorted(Mapping.set_order_range())
+        for m in sorted(csv_properties, key=lambda m: m.code_name) if m.set_order == i
+    ]
+    assert MAPPING_PLAN.csv_names == {m.csv_name for m in csv_properties}
+    assert MAPPING_PLAN.dhis_fields == tuple(
+        (m.code_name, m.dhis_uid) for m in Mapping.properties() if m.dhis_uid is not None
+    )
+
+
 def open_json(filename):
     with open(os.path.join(Config.ROOT_DIR, 'metadata', filename)) as f:
         return json.load(f)
@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+from smartvadhis2.core.pipeline import Pipeline, Stage
+
+
+def test_pipeline_keeps_order():
+    def slow_square(i):
+        # later items finish first
+        time.sleep(0.001 * (20 - i))
+        return i * i
+
+    pipeline = Pipeline([Stage('square', slow_square, workers=4), Stage('add', lambda i: i + 1)], queue_size=2)
+    assert list(pipeline.run(range(20))) == [i * i + 1 for i in range(20)]
+
+
+def test_pipeline_bounded():
+    read = []
+    lock = threading.Lock()
+
+    def source():
+        for i in range(100):
+            with lock:
+                read.append(i)
+            yield i
+
+    pipeline = Pipeline([Stage('identity', lambda i: i)], queue_size=2)
+    results = pipeline.run(source())
+    next(results)
+    time.sleep(0.2)
+    # the source is held back while the consumer does not take items
+    assert len(read) < 10
+    assert list(results) == list(range(1, 100))
+
+
+def test_pipeline_raises():
+    def fail(i):
+        if i == 3:
+            raise ValueError(i)
+        return i
+
+    pipeline = Pipeline([Stage('fail', fail, workers=2), Stage('identity', lambda i: i)], queue_size=2)
+    results = []
+    with pytest.raises(ValueError):
+        for i in pipeline.run(range(100)):
+            results.append(i)
+    assert results == [0, 1, 2]
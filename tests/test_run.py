@@ -1,9 +1,34 @@
+import csv
 import os
+import threading
+import time
+
 import pytest
 
-from smartvadhis2.run import _parse_args
+from smartvadhis2 import run
+from smartvadhis2.run import (
+    _parse_args,
+    _post_chunk,
+    _read_ahead,
+    _job,
+    _lookup_failures,
+    _validate,
+    _duplicate_sid_winners,
+    _import,
+    _run,
+    FileCheckpoint,
+    Job
+)
 from smartvadhis2.core.helpers import csv_with_content
-from smartvadhis2.core.config import Config
+from smartvadhis2.core.config import Config, DhisConfig, PipelineConfig
+from smartvadhis2.core.database import Database
+from smartvadhis2.core.exceptions.errors import (
+    DuplicateEventImportError,
+    DuplicateSidInFileError,
+    OrgunitNotValidImportError,
+    SexParseError
+)
+from smartvadhis2.core.verbalautopsy import validation_hash
 
 
 def file_testdata(filename):
@@ -36,3 +61,189 @@ def test_parse_args_no_args():
 def test_csv_with_content_exists():
     briefcase_file = file_testdata('briefcase_valid.csv')
     assert csv_with_content(briefcase_file)
+
+
+class FakeEvent(object):
+    def __init__(self, sid):
+        self.sid = sid
+        self.payload = {'event': sid.lower()}
+
+
+class FakeDhis(object):
+    def post_event(self, event):
+        if event.payload['event'] == 'va_3':
+            raise OrgunitNotValidImportError('invalid')
+        return event.payload['event']
+
+
+def test_post_chunk_in_order(monkeypatch):
+    monkeypatch.setattr(DhisConfig, 'bulk_chunk_size', 0)
+    events = [FakeEvent('VA_1'), FakeEvent('VA_2'), FakeEvent('VA_3')]
+    results = _post_chunk(FakeDhis(), events, existing={'VA_2': ['abc']})
+
+    assert results[0] == ('va_1', None)
+    assert isinstance(results[1][1], DuplicateEventImportError)
+    assert isinstance(results[2][1], OrgunitNotValidImportError)
+
+
+class SlowDhis(object):
+    """Counts the POSTs in flight, each takes 5 ms"""
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def post_event(self, event):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.005)
+        with self.lock:
+            self.in_flight -= 1
+        return event.uid
+
+
+def valid_smartva_file(tmp_path, count):
+    """A SmartVA file of `count` valid records with unique SIDs"""
+    template = list(csv.DictReader(open(file_testdata('smartva_test.csv'))))
+    path = str(tmp_path / 'smartva.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(template[0].keys()))
+        writer.writeheader()
+        for i in range(count):
+            row = dict(template[i % 3])
+            row.update(sid='VA_{:017d}'.format(i), age=['48', '82', '0.02'][i % 3], birth_date='1970-01-01')
+            writer.writerow(row)
+    return path
+
+
+def test_import_posts_concurrently(monkeypatch, tmp_path):
+    monkeypatch.setattr(DhisConfig, 'workers', 4)
+    monkeypatch.setattr(DhisConfig, 'bulk_chunk_size', 0)
+    monkeypatch.setattr(DhisConfig, 'skip_duplicate_check', True)
+    dhis = SlowDhis()
+    db = Database('sqlite:///' + str(tmp_path / 'local.db'))
+
+    summary = _import(valid_smartva_file(tmp_path, 40), dhis, db)
+    db.close()
+    assert summary.imported == 40
+    assert dhis.max_in_flight > 1
+
+
+class FakeBriefcase(object):
+    def __init__(self, briefcase_file):
+        self.briefcase_file = briefcase_file
+
+    def download_briefcases(self, download_all):
+        return self.briefcase_file
+
+
+class FakeSmartVA(object):
+    def run(self, briefcase_file, manual=False):
+        return briefcase_file
+
+
+def test_run_continues_after_failed_resume(monkeypatch, tmp_path):
+    (tmp_path / 'interrupted').mkdir()
+    (tmp_path / 'new').mkdir()
+    interrupted = valid_smartva_file(tmp_path / 'interrupted', 3)
+    new = valid_smartva_file(tmp_path / 'new', 3)
+    db = Database('sqlite:///' + str(tmp_path / 'local.db'))
+    FileCheckpoint(interrupted, db)
+
+    imported = []
+
+    def import_file(smartva_file, dhis, db):
+        if smartva_file == interrupted:
+            raise ValueError("Bug detected")
+        imported.append(smartva_file)
+
+    monkeypatch.setattr(run, '_import_file', import_file)
+    monkeypatch.setattr(run, 'access', lambda: (None, FakeBriefcase(new), FakeSmartVA(), db))
+    _run(manual=None, download_all=False)
+    assert imported == [new]
+    # the file is not resumed again by later runs
+    assert db.unfinished_checkpoints() == []
+    db.close()
+
+
+def test_read_ahead_resumes_after_lastrow():
+    smartva_file = file_testdata('smartva_test.csv')
+    rows = [index for window in _read_ahead(smartva_file, lastrow=1) for index, _, _ in window]
+    assert rows == [2, 3]
+
+
+class FakeDb(object):
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.calls = []
+
+    def validation_failures(self, rowhashes):
+        return {rowhash: self.failures[rowhash] for rowhash in rowhashes if rowhash in self.failures}
+
+    def get_checkpoint(self, filehash):
+        return None
+
+    def write_checkpoint(self, filehash, filename, lastrow, summary):
+        self.calls.append(('checkpoint', lastrow))
+
+    def delete_checkpoint(self, filehash):
+        self.calls.append(('delete',))
+
+    def flush(self):
+        self.calls.append(('flush',))
+
+
+def test_lookup_failures_skips_validation():
+    smartva_file = file_testdata('smartva_test.csv')
+    window = next(_read_ahead(smartva_file))
+    jobs = [_job(index, record, progress, set(), {}) for index, record, progress in window]
+    db = FakeDb({validation_hash(jobs[0].record): ([SexParseError.code], [])})
+
+    _lookup_failures(db, jobs)
+    _validate(jobs)
+    assert jobs[0].cached
+    assert [type(e) for e in jobs[0].errors] == [SexParseError]
+    assert jobs[0].va is None and jobs[0].event is None
+    assert not any(job.cached for job in jobs[1:])
+    assert all(job.va is not None for job in jobs[1:])
+
+
+def test_checkpoint_flushes_failures_first():
+    db = FakeDb()
+    checkpoint = FileCheckpoint(file_testdata('smartva_test.csv'), db)
+    for index in range(1, 201):
+        checkpoint.handled(Job(index, {}, 0.0))
+    checkpoint.finish()
+    assert db.calls == [('checkpoint', 0),
+                        ('flush',), ('checkpoint', 100),
+                        ('flush',), ('checkpoint', 200),
+                        ('flush',), ('delete',)]
+
+
+@pytest.fixture
+def duplicate_sids(tmpdir):
+    smartva_file = tmpdir.join('duplicates.csv')
+    smartva_file.write('sid,interview_date\n'
+                       'VA_1,"Mar 27, 2018"\n'
+                       'VA_2,"Mar 26, 2018"\n'
+                       'VA_1,"Mar 26, 2018"\n'
+                       'VA_3,\n'
+                       'VA_2,2018-03-26\n')
+    return str(smartva_file)
+
+
+@pytest.mark.parametrize("rule, expected, superseded", [
+    ('last_row', {'VA_1': 3, 'VA_2': 5}, [1, 2]),
+    # the last row wins on the same date
+    ('latest_interview_date', {'VA_1': 1, 'VA_2': 5}, [2, 3])
+])
+def test_duplicate_sid_winners(monkeypatch, duplicate_sids, rule, expected, superseded):
+    monkeypatch.setattr(PipelineConfig, 'duplicate_sid_winner', rule)
+    winners = _duplicate_sid_winners(duplicate_sids)
+    assert winners == expected
+
+    jobs = [_job(index, record, progress, set(), winners) for index, record, progress in
+            next(_read_ahead(duplicate_sids))]
+    assert [job.index for job in jobs if job.skipped] == superseded
+    assert all(isinstance(jobs[index - 1].superseded, DuplicateSidInFileError) for index in superseded)
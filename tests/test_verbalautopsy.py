@@ -1,5 +1,6 @@
 import datetime
 import json
+from concurrent.futures import ProcessPoolExecutor
 
 import pytest
 
@@ -8,7 +9,22 @@ from smartvadhis2.core.exceptions.errors import *
 from smartvadhis2.core.exceptions.warnings import *
 from smartvadhis2.core.mapping import *
 from smartvadhis2.core.config import ODKConfig, SmartVAConfig
-from smartvadhis2.core.verbalautopsy import VerbalAutopsy, Event, process_row_data, verbal_autopsy_factory
+from smartvadhis2.core.verbalautopsy import (
+    VerbalAutopsy,
+    Event,
+    process_row_data,
+    verbal_autopsy_factory,
+    validate_compact,
+    verbal_autopsy_from_compact,
+    validate_batch,
+    mask_codes,
+    validation_hash,
+    events_body,
+    ERROR_BASE,
+    WARNING_BASE
+)
+from smartvadhis2.core import helpers, verbalautopsy
+from smartvadhis2.core.helpers import DictionaryColumn
 
 
 class VaAbstractClass(object):
@@ -268,6 +284,24 @@ class TestVAClassMethods(VaAbstractClass):
     def test_getattr(self, va):
         assert va.notexistent is None
 
+    def test_slots(self, va):
+        assert '__dict__' not in VerbalAutopsy.__dict__
+        assert va.keys() == tuple(sorted(m.code_name for m in Mapping.properties()))
+        with pytest.raises(AttributeError):
+            va.notexistent = 1
+
+    def test_dict_incomplete(self, va):
+        va.icd10 = 'C16'
+        # cause of death is unknown without age category
+        assert dict(va)['cause_of_death'] is None
+        assert json.loads(str(va))['icd10'] == 15
+
+    def test_state(self, va):
+        va.age = '22.0'
+        va.sid = 'VA_12345678912345678'
+        restored = VerbalAutopsy.from_state(va.state())
+        assert dict(restored) == dict(va)
+
     def test_str(self, capsys, va):
         va.age = '22.0'
         va.icd10 = 'C16'
@@ -374,6 +408,83 @@ def test_verbal_autopsy_factory_exceptions():
     assert all(isinstance(w, ValidationWarning) for w in war)
 
 
+def test_validation_hash(monkeypatch):
+    data = {
+        Age.csv_name: '22.01231',
+        Sex.csv_name: '7',
+        Sid.csv_name: 'VA_12345678912345678'
+    }
+    rowhash = validation_hash(data)
+    # whitespace and columns that are not mapped do not change the validation
+    assert validation_hash(dict(data, **{Age.csv_name: ' 22.01231 ', 'not_mapped': 'x'})) == rowhash
+    assert validation_hash(dict(data, **{Sex.csv_name: '1'})) != rowhash
+
+    monkeypatch.setattr(ODKConfig, 'sid_regex', r'^VA_[0-9]{5}$')
+    assert validation_hash(data) != rowhash
+
+
+def test_validate_compact_in_process():
+    valid = {
+        Age.csv_name: '22.01231',
+        InterviewDate.csv_name: 'Mar 26, 2018',
+        Orgunit.csv_name: 'Aq72mcgPpbH',
+        Icd10.csv_name: 'B24',
+        Sex.csv_name: '1',
+        Sid.csv_name: 'VA_12345678912345678'
+    }
+    invalid = dict(valid, **{Sex.csv_name: '7', Icd10.csv_name: ''})
+
+    with ProcessPoolExecutor(max_workers=1) as processes:
+        compact = processes.submit(validate_compact, [valid, invalid]).result()
+
+    for data, result in zip([valid, invalid], compact):
+        va, exc, war = verbal_autopsy_from_compact(*result)
+        expected_va, expected_exc, expected_war = verbal_autopsy_factory(data)
+        assert va.state() == expected_va.state()
+        assert [type(e) for e in exc] == [type(e) for e in expected_exc]
+        assert [type(w) for w in war] == [type(w) for w in expected_war]
+    assert {type(e) for e in verbal_autopsy_from_compact(*compact[1])[1]} == {SexParseError, Icd10MissingError}
+
+
+@pytest.mark.parametrize('with_numpy', [True, False])
+def test_validate_batch(monkeypatch, with_numpy):
+    if with_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(verbalautopsy, 'numpy', None)
+
+    valid = {
+        Age.csv_name: '22.01231',
+        BirthDate.csv_name: '1990-01-01',
+        InterviewDate.csv_name: 'Mar 26, 2018',
+        FirstName.csv_name: 'Toni',
+        Surname.csv_name: 'König',
+        Orgunit.csv_name: 'Aq72mcgPpbH',
+        Icd10.csv_name: 'B24',
+        Sex.csv_name: '1',
+        Sid.csv_name: 'VA_12345678912345678'
+    }
+    rows = [
+        valid,
+        dict(valid, **{Age.csv_name: '140', Sex.csv_name: '7', Icd10.csv_name: 'XXX'}),
+        dict(valid, **{Age.csv_name: ' ', Orgunit.csv_name: 'not-a-uid', InterviewDate.csv_name: '26.03.2018'}),
+        dict(valid, **{BirthDate.csv_name: '1990-13-01', Sid.csv_name: 'VA_1', FirstName.csv_name: ''}),
+        {}
+    ]
+    columns = {csv_name: [row.get(csv_name) for row in rows] for csv_name in valid}
+    # columns may be given dictionary-encoded
+    columns[Sex.csv_name] = DictionaryColumn.encode(columns[Sex.csv_name])
+    errors, warnings = validate_batch(columns)
+
+    assert len(errors) == len(warnings) == len(rows)
+    for row, error_mask, warning_mask in zip(rows, errors, warnings):
+        _, exc, war = verbal_autopsy_factory(row)
+        assert mask_codes(error_mask, ERROR_BASE) == sorted(e.code for e in exc)
+        assert mask_codes(warning_mask, WARNING_BASE) == sorted(w.code for w in war)
+    assert errors[0] == 0
+    assert mask_codes(errors[1], ERROR_BASE) == [AgeOutOfBoundsError.code, Icd10ParseError.code, SexParseError.code]
+
+
 class TestEvent(object):
 
     @pytest.fixture
@@ -400,6 +511,11 @@ class TestEvent(object):
         ev = Event(va)
         assert ev.orgunit == 'htJeatF5ITk'
 
+    def test_event_uid(self, va):
+        ev = Event(va)
+        assert ev.payload['event'] == ev.uid
+        assert ev.uid == Event(va).uid
+
     def test_event_date(self, va):
         ev = Event(va)
         assert ev.event_date == '2018-01-01'
@@ -459,3 +575,11 @@ class TestEvent(object):
         assert all([k in captured.out for k in expected.keys()])
         pairs = zip(json.loads(captured.out).get('dataValues'), expected['dataValues'])
         assert any(x != y for x, y in pairs)
+
+    @pytest.mark.parametrize("fast_json", [True, False])
+    def test_event_body(self, va, monkeypatch, fast_json):
+        if not fast_json:
+            monkeypatch.setattr(helpers, 'orjson', None)
+        ev = Event(va)
+        assert json.loads(ev.body.decode('utf-8')) == ev.payload
+        assert json.loads(events_body([ev, ev]).decode('utf-8')) == {'events': [ev.payload, ev.payload]}